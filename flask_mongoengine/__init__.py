@@ -2,19 +2,35 @@
 from __future__ import absolute_import
 import inspect
 
-from flask import Flask, abort, current_app
+from flask import Flask, abort, current_app, g, request
 import mongoengine
 from mongoengine.base.fields import BaseField
+from mongoengine.connection import get_db
 from mongoengine.errors import ValidationError
-from mongoengine.queryset import (DoesNotExist, MultipleObjectsReturned,
+from mongoengine.queryset import (DoesNotExist, MultipleObjectsReturned, Q,
                                   QuerySet)
+import six
 
+from .cache import *
+from .cache import cached_query
 from .connection import *
+from .connection import _check_fork
+from .identity_map import *
+from .identity_map import _teardown_identity_map
+from .json import *
 from .json import override_json_encoder
 from .pagination import *
 from .sessions import *
+from .tenants import *
+from .tenants import _databases, get_tenant_collection
 from .wtf import WtfBaseField
 
+# TODO remove once Flask < 0.11 support is dropped
+try:
+    from .cli import mongoengine_cli
+except ImportError:
+    mongoengine_cli = None
+
 
 VERSION = (0, 9, 3)
 
@@ -85,6 +101,64 @@ def _include_mongoengine(obj):
                 _patch_base_field(obj, attr_name)
 
 
+def _route_reads(app, rules):
+    """
+    Route the reads of the requests handled by the endpoints or
+    blueprints named in `rules` to the read preference given for them,
+    e.g. {'reports': 'secondaryPreferred',
+          'api.export': {'mode': 'secondary', 'max_staleness': 120}}.
+    Endpoint rules take precedence over blueprint ones.
+    """
+    routes = {}
+    for name, rule in rules.items():
+        if not isinstance(rule, dict):
+            rule = {'mode': rule}
+        routes[name] = read_from(**rule)
+
+    @app.before_request
+    def start_reading_from():
+        route = routes.get(request.endpoint) or routes.get(request.blueprint)
+        if route is not None:
+            route.__enter__()
+            g._mongoengine_read_from = route
+
+    @app.teardown_request
+    def stop_reading_from(exception=None):
+        route = getattr(g, '_mongoengine_read_from', None)
+        if route is not None:
+            del g._mongoengine_read_from
+            route.__exit__(None, None, None)
+
+
+def _route_tenants(app, db, default_alias):
+    """
+    Route the documents of each request to the database of its tenant,
+    as resolved by the resolver set with MongoEngine.tenant_resolver or
+    the "MONGODB_TENANT_RESOLVER" config var.
+    """
+    @app.before_request
+    def start_routing_tenant():
+        resolver = db._tenant_resolver or app.config.get('MONGODB_TENANT_RESOLVER')
+        tenant = resolver() if resolver is not None else None
+        if tenant is None:
+            return
+
+        if isinstance(tenant, tuple):
+            alias, db_name = tenant
+        else:
+            alias, db_name = default_alias, tenant
+        route = use_tenant(db_name, alias)
+        route.__enter__()
+        g._mongoengine_tenant = route
+
+    @app.teardown_request
+    def stop_routing_tenant(exception=None):
+        route = getattr(g, '_mongoengine_tenant', None)
+        if route is not None:
+            del g._mongoengine_tenant
+            route.__exit__(None, None, None)
+
+
 def current_mongoengine_instance():
     """Return a MongoEngine instance associated with current Flask app."""
     me = current_app.extensions.get('mongoengine', {})
@@ -100,6 +174,7 @@ class MongoEngine(object):
         _include_mongoengine(self)
 
         self.app = None
+        self._tenant_resolver = None
         self.Document = Document
         self.DynamicDocument = DynamicDocument
 
@@ -117,6 +192,14 @@ class MongoEngine(object):
         # Make documents JSON serializable
         override_json_encoder(app)
 
+        # Register the "flask mongoengine" commands
+        if mongoengine_cli is not None:
+            app.cli.add_command(mongoengine_cli)
+
+        # Drop the documents remembered by the identity map (if enabled)
+        # once the app context is gone
+        app.teardown_appcontext(_teardown_identity_map)
+
         if 'mongoengine' not in app.extensions:
             app.extensions['mongoengine'] = {}
 
@@ -130,12 +213,39 @@ class MongoEngine(object):
             # from the app config.
             config = app.config
 
-        # Obtain db connection(s)
-        connections = create_connections(config)
+        # Register db connection(s), which are opened on first use
+        aliases = register_connections(config)
+
+        # Monitor the health of the connection(s) in the background, so
+        # that reads can fail over to a fallback alias. The monitors are
+        # started on first use, in the process using the connections.
+        interval = config.get('MONGODB_HEALTH_CHECK_INTERVAL')
+        if interval:
+            for alias in aliases if isinstance(aliases, list) else [aliases]:
+                monitor_health(
+                    alias, interval,
+                    config.get('MONGODB_HEALTH_CHECK_TIMEOUT', 2),
+                    config.get('MONGODB_HEALTH_CHECK_LATENCY_THRESHOLD'))
+
+        # Route reads of certain endpoints and blueprints to secondaries
+        rules = config.get('MONGODB_READ_PREFERENCE_RULES')
+        if rules:
+            _route_reads(app, rules)
+
+        # Route the documents of each request to its tenant's database
+        _route_tenants(app, self, config.get('MONGODB_TENANT_ALIAS',
+                                             mongoengine.DEFAULT_CONNECTION_NAME))
+        if config.get('MONGODB_TENANT_CACHE_SIZE'):
+            _databases.max_size = config['MONGODB_TENANT_CACHE_SIZE']
+
+        # Backend of the QuerySet.cache() results
+        cache = config.get('MONGODB_CACHE_BACKEND')
+        if cache is None:
+            cache = MemoryCache(config.get('MONGODB_CACHE_MAX_SIZE', 1000))
 
         # Store objects in application instance so that multiple apps do not
         # end up accessing the same objects.
-        s = {'app': app, 'conn': connections}
+        s = {'app': app, 'aliases': aliases, 'cache': cache, 'counts': {}}
         app.extensions['mongoengine'][self] = s
 
     @property
@@ -144,37 +254,316 @@ class MongoEngine(object):
         Return MongoDB connection(s) associated with this MongoEngine
         instance.
         """
-        return current_app.extensions['mongoengine'][self]['conn']
+        aliases = current_app.extensions['mongoengine'][self]['aliases']
+        if isinstance(aliases, list):
+            return dict((alias, get_connection(alias)) for alias in aliases)
+        return get_connection(aliases)
+
+    def read_from(self, mode, tag_sets=None, max_staleness=None):
+        """
+        Return a context manager (which also works as a decorator)
+        routing all the reads inside it to the given read preference,
+        e.g. db.read_from('secondaryPreferred', max_staleness=120).
+        """
+        return read_from(mode, tag_sets, max_staleness)
+
+    def tenant_resolver(self, f):
+        """
+        Decorator setting the function resolving the tenant of each
+        request, e.g. from its subdomain or a header. It returns the
+        tenant's database name, which lives on the cluster of the
+        "MONGODB_TENANT_ALIAS" connection, an (alias, database name)
+        tuple, or None to use the documents' own databases.
+        """
+        self._tenant_resolver = f
+        return f
+
+    def tenant(self, db_name, alias=mongoengine.DEFAULT_CONNECTION_NAME):
+        """
+        Return a context manager (which also works as a decorator)
+        routing the documents inside it to a tenant's database, e.g.
+        db.tenant('acme').
+        """
+        return use_tenant(db_name, alias)
+
+    @property
+    def identity_map(self):
+        """
+        Return the :class:`IdentityMap` of the current app context, or
+        None if "MONGODB_IDENTITY_MAP" isn't enabled.
+        """
+        return get_identity_map()
 
 
 class BaseQuerySet(QuerySet):
     """Mongoengine's queryset extended with handy extras."""
 
+    # Set by cache()
+    _cache_ttl = None
+    _cache_backend = None
+    _cache_max_results = None
+
+    def _clone_into(self, new_qs):
+        new_qs = super(BaseQuerySet, self)._clone_into(new_qs)
+        new_qs._cache_ttl = self._cache_ttl
+        new_qs._cache_backend = self._cache_backend
+        new_qs._cache_max_results = self._cache_max_results
+        return new_qs
+
+    def cache(self, ttl=60, backend=None, max_results=100):
+        """
+        Return a copy of the QuerySet whose get(), first() and iteration
+        results are read through a cache for `ttl` seconds. The cache
+        backend of the current app is used unless `backend` is given.
+        Iteration results with more than `max_results` docs aren't
+        cached. Cached results are invalidated whenever a document of
+        the same collection is saved or deleted.
+        """
+        queryset = self.clone()
+        queryset._cache_ttl = ttl
+        queryset._cache_backend = backend
+        queryset._cache_max_results = max_results
+        return queryset
+
+    @property
+    def _cursor(self):
+        if self._cursor_obj is not None:
+            return super(BaseQuerySet, self)._cursor
+
+        # Apply the read preference of the enclosing read_from block, if
+        # any, unless the QuerySet has one of its own
+        read_preference = None
+        if self._read_preference is None:
+            read_preference = get_read_preference()
+
+        # Read from the fallback alias while the document's is degraded
+        tenant = get_tenant(self._document)
+        if tenant is not None:
+            alias = tenant[0]
+        else:
+            alias = (self._document._meta.get('db_alias') or
+                     mongoengine.DEFAULT_CONNECTION_NAME)
+        read_alias = get_read_alias(alias)
+
+        if read_preference is None and read_alias == alias:
+            return super(BaseQuerySet, self)._cursor
+
+        collection = self._collection_obj
+        if read_preference is not None:
+            self._read_preference = read_preference
+        if read_alias != alias and tenant is not None:
+            self._collection_obj = get_connection(read_alias)[
+                collection.database.name][collection.name]
+        elif read_alias != alias:
+            self._collection_obj = get_db(read_alias)[collection.name]
+        try:
+            return super(BaseQuerySet, self)._cursor
+        finally:
+            if read_preference is not None:
+                self._read_preference = None
+            self._collection_obj = collection
+
+    def _uses_cache(self):
+        return (self._cache_ttl is not None and not self._as_pymongo and
+                not self._scalar)
+
+    def _without_cache(self):
+        queryset = self.clone()
+        queryset._cache_ttl = None
+        return queryset
+
+    def _cached(self, operation, fetch, max_results=None):
+        backend = self._cache_backend or get_cache_backend()
+        return cached_query(backend, self, operation, self._cache_ttl, fetch,
+                            max_results)
+
+    def __iter__(self):
+        if not self._uses_cache():
+            return super(BaseQuerySet, self).__iter__()
+
+        def fetch():
+            return list(self._without_cache())
+        return iter(self._cached('list', fetch, self._cache_max_results))
+
+    def first(self):
+        """
+        Same as QuerySet.first, but reads through the cache if the
+        QuerySet is cached.
+        """
+        if not self._uses_cache():
+            return super(BaseQuerySet, self).first()
+
+        def fetch():
+            doc = super(BaseQuerySet, self._without_cache()).first()
+            return [doc] if doc is not None else []
+        docs = self._cached('first', fetch)
+        return docs[0] if docs else None
+
+    def _project(self, only=None, exclude=None, as_pymongo=False):
+        """
+        Return a copy of the QuerySet which only loads the fields listed
+        in `only`, skips the ones listed in `exclude` and, if
+        `as_pymongo` is True, returns raw dicts instead of documents.
+        """
+        queryset = self
+        if only:
+            if isinstance(only, six.string_types):
+                only = [only]
+            queryset = queryset.only(*only)
+        if exclude:
+            if isinstance(exclude, six.string_types):
+                exclude = [exclude]
+            queryset = queryset.exclude(*exclude)
+        if as_pymongo:
+            queryset = queryset.as_pymongo()
+        return queryset
+
+    def _is_plain(self):
+        """
+        Return True if the QuerySet loads whole documents without any
+        filters, i.e. if it's safe to satisfy primary key lookups from
+        the identity map.
+        """
+        return (isinstance(self._query_obj, Q) and not self._query_obj.query and
+                not self._loaded_fields and not self._as_pymongo and
+                not self._scalar and self._skip is None and
+                self._limit is None and not getattr(self, '_none', False))
+
+    def _identity_map_pk(self, q_objs, query):
+        """
+        Return the primary key looked up by a call to get(), or None if
+        the lookup isn't a plain primary key lookup.
+        """
+        if q_objs or len(query) != 1 or not self._is_plain():
+            return None
+
+        name, value = list(query.items())[0]
+        pk_name = self._document._meta['id_field']
+        if name not in ('pk', pk_name):
+            return None
+        return self._document._fields[pk_name].to_python(value)
+
+    def get(self, *q_objs, **query):
+        """
+        Same as QuerySet.get, but looks up documents loaded by their
+        primary key in the identity map of the current app context first,
+        if it's enabled, and reads through the cache if the QuerySet is
+        cached.
+        """
+        identity_map = get_identity_map()
+        pk = None
+        if identity_map is not None:
+            pk = self._identity_map_pk(q_objs, query)
+            if pk is not None:
+                doc = identity_map.get(self._document, pk)
+                if doc is not None:
+                    return doc
+
+        if self._uses_cache():
+            queryset = self.filter(*q_objs, **query)
+
+            def fetch():
+                return [super(BaseQuerySet, queryset._without_cache()).get()]
+            doc = queryset._cached('get', fetch)[0]
+        else:
+            doc = super(BaseQuerySet, self).get(*q_objs, **query)
+
+        if pk is not None:
+            identity_map.add(doc)
+        return doc
+
+    def in_bulk(self, object_ids):
+        """
+        Same as QuerySet.in_bulk, but only queries for the documents
+        which aren't in the identity map of the current app context yet,
+        if it's enabled.
+        """
+        identity_map = get_identity_map()
+        if identity_map is None or not self._is_plain():
+            return super(BaseQuerySet, self).in_bulk(object_ids)
+
+        pk_field = self._document._fields[self._document._meta['id_field']]
+        docs = {}
+        missing = []
+        for pk in object_ids:
+            pk = pk_field.to_python(pk)
+            doc = identity_map.get(self._document, pk)
+            if doc is None:
+                missing.append(pk)
+            else:
+                docs[pk] = doc
+
+        if missing:
+            loaded = super(BaseQuerySet, self).in_bulk(missing)
+            for pk, doc in loaded.items():
+                identity_map.add(doc)
+                docs[pk] = doc
+        return docs
+
+    def _invalidate(self):
+        """
+        Forget the documents of this collection loaded into the identity
+        map or the cache, as they're about to change.
+        """
+        identity_map = get_identity_map()
+        if identity_map is not None:
+            identity_map.discard(self._document)
+        invalidate(self._document)
+
+    def delete(self, *args, **kwargs):
+        self._invalidate()
+        return super(BaseQuerySet, self).delete(*args, **kwargs)
+
+    def update(self, *args, **kwargs):
+        self._invalidate()
+        return super(BaseQuerySet, self).update(*args, **kwargs)
+
+    def modify(self, *args, **kwargs):
+        self._invalidate()
+        return super(BaseQuerySet, self).modify(*args, **kwargs)
+
     def get_or_404(self, *args, **kwargs):
         """
         Get a document and raise a 404 Not Found error if it doesn't
-        exist.
+        exist. The `only`, `exclude` and `as_pymongo` keyword arguments
+        limit what's loaded, like the QuerySet methods of the same name.
         """
+        queryset = self._project(kwargs.pop('only', None),
+                                 kwargs.pop('exclude', None),
+                                 kwargs.pop('as_pymongo', False))
         try:
-            return self.get(*args, **kwargs)
+            return queryset.get(*args, **kwargs)
         except (MultipleObjectsReturned, DoesNotExist, ValidationError):
             # TODO probably only DoesNotExist should raise a 404
             abort(404)
 
-    def first_or_404(self):
+    def first_or_404(self, only=None, exclude=None, as_pymongo=False):
         """Same as get_or_404, but uses .first, not .get."""
-        obj = self.first()
+        obj = self._project(only, exclude, as_pymongo).first()
         if obj is None:
             abort(404)
 
         return obj
 
-    def paginate(self, page, per_page, **kwargs):
+    def paginate(self, page, per_page, only=None, exclude=None,
+                 as_pymongo=False, **kwargs):
         """
         Paginate the QuerySet with a certain number of docs per page
-        and return docs for a given page.
+        and return docs for a given page. The `only`, `exclude` and
+        `as_pymongo` arguments limit what's loaded for every doc. Extra
+        keyword arguments, such as `count`, are passed on to
+        :class:`Pagination`.
         """
-        return Pagination(self, page, per_page)
+        queryset = self._project(only, exclude, as_pymongo)
+        return Pagination(queryset, page, per_page, **kwargs)
+
+    def paginate_after(self, cursor, per_page, sort=None):
+        """
+        Paginate the QuerySet by seeking past a cursor rather than
+        skipping a number of docs, so that deep pages are as cheap as
+        the first one.
+        """
+        return KeysetPagination(self, per_page, cursor=cursor, sort=sort)
 
     def paginate_field(self, field_name, doc_id, page, per_page, total=None):
         """
@@ -182,9 +571,6 @@ class BaseQuerySet(QuerySet):
         QuerySet.
         """
         # TODO this doesn't sound useful at all - remove in next release?
-        item = self.get(id=doc_id)
-        count = getattr(item, field_name + "_count", '')
-        total = total or count or len(getattr(item, field_name))
         return ListFieldPagination(self, doc_id, field_name, page, per_page,
                                    total=total)
 
@@ -195,6 +581,38 @@ class Document(mongoengine.Document):
     meta = {'abstract': True,
             'queryset_class': BaseQuerySet}
 
+    @classmethod
+    def _get_db(cls):
+        # The connections of the parent process can't be reused after a
+        # fork, which os.register_at_fork doesn't catch on older Pythons
+        _check_fork()
+        db = get_tenant_db(cls)
+        if db is None:
+            db = super(Document, cls)._get_db()
+        return db
+
+    @classmethod
+    def _get_collection(cls):
+        _check_fork()
+        collection = get_tenant_collection(cls)
+        if collection is None:
+            collection = super(Document, cls)._get_collection()
+        return collection
+
+    def save(self, *args, **kwargs):
+        result = super(Document, self).save(*args, **kwargs)
+        # Another instance of the document may be in the identity map
+        identity_map = get_identity_map()
+        if identity_map is not None:
+            identity_map.remove(self)
+        return result
+
+    def delete(self, *args, **kwargs):
+        identity_map = get_identity_map()
+        if identity_map is not None:
+            identity_map.remove(self)
+        return super(Document, self).delete(*args, **kwargs)
+
     def paginate_field(self, field_name, page, per_page, total=None):
         """Paginate items within a list field."""
         # TODO this doesn't sound useful at all - remove in next release?
@@ -209,3 +627,33 @@ class DynamicDocument(mongoengine.DynamicDocument):
 
     meta = {'abstract': True,
             'queryset_class': BaseQuerySet}
+
+    @classmethod
+    def _get_db(cls):
+        _check_fork()
+        db = get_tenant_db(cls)
+        if db is None:
+            db = super(DynamicDocument, cls)._get_db()
+        return db
+
+    @classmethod
+    def _get_collection(cls):
+        _check_fork()
+        collection = get_tenant_collection(cls)
+        if collection is None:
+            collection = super(DynamicDocument, cls)._get_collection()
+        return collection
+
+    def save(self, *args, **kwargs):
+        result = super(DynamicDocument, self).save(*args, **kwargs)
+        # Another instance of the document may be in the identity map
+        identity_map = get_identity_map()
+        if identity_map is not None:
+            identity_map.remove(self)
+        return result
+
+    def delete(self, *args, **kwargs):
+        identity_map = get_identity_map()
+        if identity_map is not None:
+            identity_map.remove(self)
+        return super(DynamicDocument, self).delete(*args, **kwargs)
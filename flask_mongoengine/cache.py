@@ -0,0 +1,187 @@
+import collections
+import hashlib
+import threading
+import time
+import uuid
+import weakref
+
+from bson import BSON, json_util
+from flask import current_app, has_app_context
+from mongoengine import signals
+
+from .tenants import get_tenant
+
+__all__ = ('MemoryCache', 'RedisCache', 'get_cache_backend', 'invalidate')
+
+
+class MemoryCache(object):
+    """
+    In-process cache backend which keeps up to `max_size` entries and
+    evicts the least recently used ones first. Unless `register` is
+    False, it's invalidated along with the other QuerySet.cache()
+    backends, so other uses of it should opt out.
+    """
+
+    def __init__(self, max_size=1000, register=True):
+        self.max_size = max_size
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+        if register:
+            _backends.add(self)
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None:
+                return None
+
+            expires_at, value = entry
+            if expires_at is not None and expires_at <= time.time():
+                return None
+
+            # Move the entry to the end, i.e. mark it as recently used
+            self._entries[key] = entry
+            return value
+
+    def set(self, key, value, ttl=None):
+        expires_at = time.time() + ttl if ttl else None
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (expires_at, value)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+class RedisCache(object):
+    """
+    Cache backend storing the entries in Redis, or anything else with a
+    compatible client (i.e. with `get(key)`, `set(key, value, ex=ttl)`
+    and `delete(key)` methods). Eviction is left to the server's `maxmemory-policy`.
+    """
+
+    def __init__(self, client, prefix='flask_mongoengine:'):
+        self.client = client
+        self.prefix = prefix
+        _backends.add(self)
+
+    def get(self, key):
+        return self.client.get(self.prefix + key)
+
+    def set(self, key, value, ttl=None):
+        self.client.set(self.prefix + key, value, ex=ttl or None)
+
+    def delete(self, key):
+        self.client.delete(self.prefix + key)
+
+
+# Every backend in use, so that an invalidation reaches all of them
+_backends = weakref.WeakSet()
+
+# Used when there's no app context, or the app doesn't have a backend
+_default_backend = MemoryCache()
+
+
+def get_cache_backend():
+    """
+    Return the cache backend of the current app, as set up by
+    MongoEngine.init_app, or the process-wide default one.
+    """
+    if has_app_context():
+        for state in current_app.extensions.get('mongoengine', {}).values():
+            if state.get('cache') is not None:
+                return state['cache']
+    return _default_backend
+
+
+def _tag(document_cls):
+    """Return the tag of the collection a document class lives in."""
+    tenant = get_tenant(document_cls)
+    if tenant is not None:
+        db = '%s/%s' % tenant
+    else:
+        db = document_cls._meta.get('db_alias') or ''
+    return 'tag:%s:%s' % (db, document_cls._get_collection_name())
+
+
+def _tag_version(backend, document_cls):
+    """
+    Return the current version of a collection's tag. Entries are only
+    valid for the version of the tag they were stored with, so changing
+    the version invalidates all of them at once. A tag missing from the
+    backend (e.g. evicted) just gets a new version.
+    """
+    tag = _tag(document_cls)
+    version = backend.get(tag)
+    if version is None:
+        version = uuid.uuid4().hex.encode('ascii')
+        backend.set(tag, version)
+    if not isinstance(version, bytes):
+        version = version.encode('ascii')
+    return version
+
+
+def invalidate(document_cls):
+    """
+    Invalidate all the cached query results of the collection a
+    document class lives in, in every backend. Deleting the tag is
+    enough, as its next version won't match any cached entry, and it
+    costs a single write whether the collection was cached or not.
+    """
+    tag = _tag(document_cls)
+    for backend in list(_backends):
+        backend.delete(tag)
+
+
+def _invalidate_document(sender, document=None, **kwargs):
+    invalidate(sender)
+
+
+if signals.signals_available:
+    signals.post_save.connect(_invalidate_document, weak=False)
+    signals.post_delete.connect(_invalidate_document, weak=False)
+
+
+def _cache_key(backend, queryset, operation):
+    """
+    Return the key of a query's results, made out of the normalized
+    query spec and the version of the collection's tag.
+    """
+    spec = json_util.dumps({
+        'op': operation,
+        'query': queryset._query,
+        'ordering': queryset._ordering,
+        'fields': queryset._loaded_fields.as_dict(),
+        'skip': queryset._skip,
+        'limit': queryset._limit,
+    }, sort_keys=True)
+    digest = hashlib.sha1(spec.encode('utf-8'))
+    digest.update(_tag_version(backend, queryset._document))
+    return 'query:%s:%s' % (queryset._document._get_collection_name(),
+                            digest.hexdigest())
+
+
+def cached_query(backend, queryset, operation, ttl, fetch, max_results=None):
+    """
+    Return the list of documents returned by `fetch()` for a given
+    query, calling it only if the results aren't in the cache yet.
+    Results with more than `max_results` documents aren't cached.
+    """
+    key = _cache_key(backend, queryset, operation)
+    data = backend.get(key)
+    if data is not None:
+        sons = BSON(data).decode()['d']
+        return [queryset._document._from_son(son) for son in sons]
+
+    docs = fetch()
+    if max_results is None or len(docs) <= max_results:
+        sons = [doc.to_mongo() for doc in docs]
+        backend.set(key, BSON.encode({'d': sons}), ttl)
+    return docs
@@ -0,0 +1,25 @@
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+
+from .sessions import MongoEngineSessionInterface
+
+__all__ = ('mongoengine_cli',)
+
+
+@click.group('mongoengine')
+def mongoengine_cli():
+    """Flask-MongoEngine commands."""
+
+
+@mongoengine_cli.command('create-session-indexes')
+@with_appcontext
+def create_session_indexes():
+    """Create the indexes of the session collections."""
+    interface = current_app.session_interface
+    if not isinstance(interface, MongoEngineSessionInterface):
+        raise click.ClickException(
+            "The app doesn't use MongoEngineSessionInterface")
+
+    for name in interface.create_indexes():
+        click.echo('Created the index of %s' % name)
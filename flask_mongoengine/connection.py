@@ -1,20 +1,103 @@
+import collections
+import functools
+import os
+import threading
+import time
+
 import mongoengine
-from pymongo import ReadPreference, uri_parser
+from mongoengine.base.common import _document_registry
+import pymongo
+from pymongo import ReadPreference, read_preferences, uri_parser
+import six
 
 
 __all__ = (
     'create_connections', 'get_connection_settings', 'InvalidSettingsError',
+    'ConnectionSettings',
+    'register_connections', 'get_connection', 'reset_connections',
+    'read_from', 'get_read_preference', 'HealthMonitor',
+    'monitor_health', 'start_health_monitor', 'stop_health_monitor',
+    'get_health_monitor', 'is_degraded', 'get_read_alias',
 )
 
 
 MONGODB_CONF_VARS = ('MONGODB_ALIAS', 'MONGODB_DB', 'MONGODB_HOST', 'MONGODB_IS_MOCK',
-                     'MONGODB_PASSWORD', 'MONGODB_PORT', 'MONGODB_USERNAME')
+                     'MONGODB_PASSWORD', 'MONGODB_PORT', 'MONGODB_USERNAME',
+                     'MONGODB_MAX_POOL_SIZE', 'MONGODB_MIN_POOL_SIZE',
+                     'MONGODB_WAIT_QUEUE_TIMEOUT_MS', 'MONGODB_FALLBACK')
+
+# Connection pool settings and the names PyMongo 3 knows them by
+POOL_SETTINGS = {
+    'max_pool_size': 'maxpoolsize',
+    'min_pool_size': 'minpoolsize',
+    'wait_queue_timeout_ms': 'waitqueuetimeoutms',
+}
+
+# ID of the process which opened the connections we know about
+_pid = os.getpid()
+
+# Sanitized settings of the most recently used configs, by frozen config
+_settings_cache = collections.OrderedDict()
+_SETTINGS_CACHE_SIZE = 128
+
+# Parsed URIs by URI, as parsing may involve DNS lookups (SRV records)
+_parsed_uris = {}
+
+# Frozen settings each alias was registered with
+_registered = {}
+
+# Alias the reads of an alias fail over to when it's degraded
+_fallbacks = {}
+
+# Health monitor of each alias, and the settings to (re)start it with
+_monitors = {}
+_monitor_settings = {}
+_monitors_lock = threading.Lock()
 
 
 class InvalidSettingsError(Exception):
     pass
 
 
+class ConnectionSettings(dict):
+    """
+    Read-only dict of sanitized connection settings. The same instance
+    is handed out for every config resolving to it, so make a copy with
+    `dict(settings)` to change it.
+    """
+
+    def _read_only(self, *args, **kwargs):
+        raise TypeError('Connection settings are read-only')
+
+    __setitem__ = __delitem__ = _read_only
+    clear = pop = popitem = setdefault = update = _read_only
+
+    def copy(self):
+        return dict(self)
+
+
+def _freeze(value):
+    """
+    Return a hashable equivalent of a config value, or raise TypeError
+    if there's none.
+    """
+    if isinstance(value, dict):
+        return tuple(sorted((k, _freeze(v)) for k, v in value.items()))
+    if isinstance(value, (list, tuple)):
+        return tuple(_freeze(v) for v in value)
+    if hasattr(value, 'mongos_mode'):
+        # PyMongo's read preferences aren't hashable
+        return (value.__class__.__name__, _freeze(value.document))
+    hash(value)
+    return value
+
+
+def _parse_uri(uri):
+    if uri not in _parsed_uris:
+        _parsed_uris[uri] = uri_parser.parse_uri(uri)
+    return _parsed_uris[uri]
+
+
 def _sanitize_settings(settings):
     """Given a dict of connection settings, sanitize the keys and fall
     back to some sane defaults.
@@ -37,7 +120,7 @@ def _sanitize_settings(settings):
         if uri_to_check.startswith('mongomock://'):
             uri_to_check = uri_to_check.replace('mongomock://', 'mongodb://')
 
-        uri_dict = uri_parser.parse_uri(uri_to_check)
+        uri_dict = _parse_uri(uri_to_check)
         resolved_settings['db'] = uri_dict['database']
 
     # Add a default name param or use the "db" key if exists
@@ -54,12 +137,19 @@ def _sanitize_settings(settings):
     # Default to ReadPreference.PRIMARY if no read_preference is supplied
     resolved_settings['read_preference'] = resolved_settings.get('read_preference', ReadPreference.PRIMARY)
 
+    # Translate the pool settings to PyMongo 3 option names
+    # TODO remove the check once PyMongo < 3.0 support is dropped
+    if pymongo.version_tuple[0] >= 3:
+        for k, option in POOL_SETTINGS.items():
+            if k in resolved_settings:
+                resolved_settings[option] = resolved_settings.pop(k)
+
     # Clean up empty values
     for k, v in list(resolved_settings.items()):
         if v is None:
             del resolved_settings[k]
 
-    return resolved_settings
+    return ConnectionSettings(resolved_settings)
 
 
 def get_connection_settings(config):
@@ -69,35 +159,60 @@ def get_connection_settings(config):
     applications, settings should exist in a "MONGODB_SETTINGS" key, but
     for backward compactibility we also support several config keys
     prefixed by "MONGODB_", e.g. "MONGODB_HOST", "MONGODB_PORT", etc.
+
+    The settings are read-only and memoized, i.e. configs resolving to
+    the same settings are only parsed once.
     """
-    # Sanitize all the settings living under a "MONGODB_SETTINGS" config var
+    # Only the MongoDB part of the config matters
     if 'MONGODB_SETTINGS' in config:
         settings = config['MONGODB_SETTINGS']
+    else:
+        settings = dict((k, v) for k, v in config.items() if k in MONGODB_CONF_VARS)  # ugly dict comprehention in order to support python 2.6
 
-        # If MONGODB_SETTINGS is a list of settings dicts, sanitize each
-        # dict separately.
-        if isinstance(settings, list):
-            # List of connection settings.
-            settings_list = []
-            for setting in settings:
-                settings_list.append(_sanitize_settings(setting))
-            return settings_list
-
-        # Otherwise, it should be a single dict describing a single connection.
-        else:
-            return _sanitize_settings(settings)
+    try:
+        key = ('MONGODB_SETTINGS' in config, _freeze(settings))
+    except TypeError:
+        # Not hashable, don't bother caching
+        return _resolve_settings(settings)
 
-    # If "MONGODB_SETTINGS" doesn't exist, sanitize the "MONGODB_" keys
-    # as if they all describe a single connection.
+    if key in _settings_cache:
+        conn_settings = _settings_cache.pop(key)
     else:
-        config = dict((k, v) for k, v in config.items() if k in MONGODB_CONF_VARS)  # ugly dict comprehention in order to support python 2.6
-        return _sanitize_settings(config)
+        conn_settings = _resolve_settings(settings)
+        if isinstance(conn_settings, list):
+            conn_settings = tuple(conn_settings)
+    _settings_cache[key] = conn_settings
+    while len(_settings_cache) > _SETTINGS_CACHE_SIZE:
+        _settings_cache.popitem(last=False)
+
+    if isinstance(conn_settings, tuple):
+        return list(conn_settings)
+    return conn_settings
+
+
+def _resolve_settings(settings):
+    """Sanitize the settings of a single connection or a list of them."""
+    # If MONGODB_SETTINGS is a list of settings dicts, sanitize each
+    # dict separately.
+    if isinstance(settings, list):
+        # List of connection settings.
+        settings_list = []
+        for setting in settings:
+            settings_list.append(_sanitize_settings(setting))
+        return settings_list
 
+    # Otherwise, it should be a single dict describing a single
+    # connection, or the "MONGODB_" keys which together describe one.
+    return _sanitize_settings(settings)
 
-def create_connections(config):
+
+def create_connections(config, fallback=None):
     """
     Given Flask application's config dict, extract relevant config vars
     out of it and establish MongoEngine connection(s) based on them.
+    Reads fail over to the `fallback` alias while a connection is
+    degraded (see :class:`HealthMonitor`), unless its settings name a
+    fallback of their own.
     """
     # Validate that the config is a dict
     if config is None or not isinstance(config, dict):
@@ -112,16 +227,377 @@ def create_connections(config):
         connections = {}
         for each in conn_settings:
             alias = each['alias']
-            connections[alias] = _connect(each)
+            connections[alias] = _connect(each, fallback)
         return connections
 
     # Otherwise, return a single connection
-    return _connect(conn_settings)
+    return _connect(conn_settings, fallback)
+
+
+def _set_fallback(conn_settings, fallback=None):
+    """Pop the fallback alias out of a dict of connection settings and
+    remember it for the connection's alias."""
+    fallback = conn_settings.pop('fallback', fallback)
+    alias = conn_settings['alias']
+    if fallback is not None and fallback != alias:
+        _fallbacks[alias] = fallback
+    else:
+        _fallbacks.pop(alias, None)
 
 
-def _connect(conn_settings):
+def _connect(conn_settings, fallback=None):
     """Given a dict of connection settings, create a connection to
     MongoDB by calling mongoengine.connect and return its result.
     """
+    conn_settings = dict(conn_settings)
+    _set_fallback(conn_settings, fallback)
     db_name = conn_settings.pop('name')
     return mongoengine.connect(db_name, **conn_settings)
+
+
+def register_connections(config, fallback=None):
+    """
+    Given Flask application's config dict, extract relevant config vars
+    out of it and register MongoEngine connection(s) based on them,
+    without connecting to MongoDB yet. Each connection is opened on its
+    first use in the current process. Return the connection alias, or a
+    list of aliases if there are multiple connections. See
+    :func:`create_connections` for `fallback`.
+    """
+    # Validate that the config is a dict
+    if config is None or not isinstance(config, dict):
+        raise InvalidSettingsError('Invalid application configuration')
+
+    # Get sanitized connection settings based on the config
+    conn_settings = get_connection_settings(config)
+
+    if isinstance(conn_settings, list):
+        return [_register(each, fallback) for each in conn_settings]
+    return _register(conn_settings, fallback)
+
+
+def _register(conn_settings, fallback=None):
+    """Given a dict of connection settings, register them under their
+    alias with mongoengine.register_connection and return the alias.
+    An alias registered again with the same settings (e.g. by another
+    app) keeps its client, and aliases with the same settings but the
+    database name share one.
+    """
+    conn_settings = dict(conn_settings)
+    _set_fallback(conn_settings, fallback)
+    alias = conn_settings.pop('alias')
+    db_name = conn_settings.pop('name')
+
+    # Don't let PyMongo connect in the background before the first
+    # operation either, e.g. before a pre-fork server forks.
+    # TODO remove the check once PyMongo < 3.0 support is dropped
+    if pymongo.version_tuple[0] >= 3 and not conn_settings.get('is_mock'):
+        conn_settings.setdefault('connect', False)
+
+    _check_fork()
+    try:
+        client_key = _freeze(conn_settings)
+    except TypeError:
+        client_key = None
+    key = (client_key, db_name)
+
+    registered = mongoengine.connection._connection_settings
+    if client_key is not None and alias in registered and _registered.get(alias) == key:
+        return alias
+
+    mongoengine.connection._connections.pop(alias, None)
+    mongoengine.connection._dbs.pop(alias, None)
+    mongoengine.register_connection(alias, name=db_name, **conn_settings)
+    _registered[alias] = key
+
+    # Share the client of another alias connected to the same cluster
+    if client_key is not None:
+        for other, (other_client_key, _) in list(_registered.items()):
+            client = mongoengine.connection._connections.get(other)
+            if (other != alias and other_client_key == client_key and
+                    other in registered and client is not None):
+                mongoengine.connection._connections[alias] = client
+                break
+    return alias
+
+
+def get_connection(alias=mongoengine.DEFAULT_CONNECTION_NAME):
+    """
+    Return the MongoClient of a registered connection alias, opening it
+    if it hasn't been used in the current process yet.
+    """
+    _check_fork()
+    _ensure_health_monitor(alias)
+    return mongoengine.connection.get_connection(alias)
+
+
+def reset_connections():
+    """
+    Forget all the opened connections so that they're reopened on their
+    next use. They aren't closed, as the sockets may still be in use by
+    the process they were inherited from. This happens automatically in
+    a forked process, but it can also be called from e.g. a post-fork
+    hook of the server.
+    """
+    global _pid
+    forked = _pid != os.getpid()
+    _pid = os.getpid()
+
+    mongoengine.connection._connections.clear()
+    mongoengine.connection._dbs.clear()
+
+    # Documents hold on to the collection of the old connection, too
+    for document_cls in _document_registry.values():
+        if getattr(document_cls, '_collection', None) is not None:
+            document_cls._collection = None
+
+    # Threads don't survive a fork: the health monitors are restarted on
+    # their next use
+    if forked:
+        _monitors.clear()
+
+
+def _check_fork():
+    """Reset the connections if we're in a process forked after they
+    were opened."""
+    if os.getpid() != _pid:
+        reset_connections()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=reset_connections)
+
+
+# Read preference classes by lower case mode name
+# TODO remove the check once PyMongo < 3.0 support is dropped
+if pymongo.version_tuple[0] >= 3:
+    READ_PREFERENCES = {
+        'primary': read_preferences.Primary,
+        'primarypreferred': read_preferences.PrimaryPreferred,
+        'secondary': read_preferences.Secondary,
+        'secondarypreferred': read_preferences.SecondaryPreferred,
+        'nearest': read_preferences.Nearest,
+    }
+else:
+    READ_PREFERENCES = {}
+
+# Stack of the read preferences set by read_from in the current thread
+_local = threading.local()
+
+
+def make_read_preference(mode, tag_sets=None, max_staleness=None):
+    """
+    Return a PyMongo read preference given its mode name (e.g.
+    'secondaryPreferred'), or the read preference itself if it's
+    already one.
+    """
+    if not isinstance(mode, six.string_types):
+        return mode
+
+    try:
+        cls = READ_PREFERENCES[mode.lower()]
+    except KeyError:
+        raise InvalidSettingsError('Invalid read preference: %s' % mode)
+
+    kwargs = {}
+    if tag_sets is not None:
+        kwargs['tag_sets'] = tag_sets
+    if max_staleness is not None:
+        kwargs['max_staleness'] = max_staleness
+    return cls(**kwargs)
+
+
+def get_read_preference():
+    """
+    Return the read preference set by the innermost read_from block in
+    the current thread, or None.
+    """
+    stack = getattr(_local, 'read_preferences', None)
+    return stack[-1] if stack else None
+
+
+class read_from(object):
+    """
+    Context manager and decorator routing all the reads of BaseQuerySets
+    inside it to the given read preference, unless a QuerySet has its
+    own read preference set.
+
+        with db.read_from('secondaryPreferred', max_staleness=120):
+            report = build_report()
+
+        @db.read_from('secondary')
+        def report():
+            ...
+    """
+
+    def __init__(self, mode, tag_sets=None, max_staleness=None):
+        self.read_preference = make_read_preference(
+            mode, tag_sets, max_staleness)
+
+    def __enter__(self):
+        if getattr(_local, 'read_preferences', None) is None:
+            _local.read_preferences = []
+        _local.read_preferences.append(self.read_preference)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        _local.read_preferences.pop()
+
+    def __call__(self, f):
+        @functools.wraps(f)
+        def decorated(*args, **kwargs):
+            with self:
+                return f(*args, **kwargs)
+        return decorated
+
+
+class HealthMonitor(threading.Thread):
+    """
+    Background thread pinging the cluster of a connection alias every
+    `interval` seconds. It records the time to the first reply, which
+    includes server selection, in `selection_latency` and the round
+    trip time of a ping on the selected server in `rtt`.
+
+    The alias is degraded while the last ping failed, while a ping has
+    been waiting for a reply for more than `timeout` seconds, or, if
+    `latency_threshold` is given, while the last selection latency was
+    above it.
+    """
+
+    def __init__(self, alias=mongoengine.DEFAULT_CONNECTION_NAME,
+                 interval=10, timeout=2, latency_threshold=None):
+        super(HealthMonitor, self).__init__(
+            name='flask_mongoengine health monitor (%s)' % alias)
+        self.daemon = True
+        self.alias = alias
+        self.interval = interval
+        self.timeout = timeout
+        self.latency_threshold = latency_threshold
+        self.pid = os.getpid()
+
+        self.selection_latency = None
+        self.rtt = None
+        self.error = None
+        self.last_check = None
+        self._failed = False
+        self._ping_started = None
+        self._stopped = threading.Event()
+
+    @property
+    def degraded(self):
+        started = self._ping_started
+        if started is not None and time.time() - started > self.timeout:
+            return True
+        return self._failed
+
+    def check(self):
+        """Ping the cluster once and record the outcome."""
+        self._ping_started = started = time.time()
+        try:
+            client = get_connection(self.alias)
+            client.admin.command('ping')
+            selected = time.time()
+            client.admin.command('ping')
+            done = time.time()
+        except pymongo.errors.PyMongoError as e:
+            self.error = e
+            self._failed = True
+        else:
+            self.selection_latency = selected - started
+            self.rtt = done - selected
+            self.error = None
+            self._failed = (self.latency_threshold is not None and
+                            self.selection_latency > self.latency_threshold)
+        finally:
+            self._ping_started = None
+            self.last_check = time.time()
+
+    def run(self):
+        while not self._stopped.is_set():
+            self.check()
+            self._stopped.wait(self.interval)
+
+    def stop(self):
+        """Stop pinging after the current check."""
+        self._stopped.set()
+
+
+def monitor_health(alias=mongoengine.DEFAULT_CONNECTION_NAME,
+                   interval=10, timeout=2, latency_threshold=None):
+    """
+    Monitor the health of a connection alias in the background (see
+    :class:`HealthMonitor`), starting the monitor on the first use of the
+    alias in each process rather than right away, e.g. in the master
+    process of a pre-fork server.
+    """
+    with _monitors_lock:
+        _monitor_settings[alias] = (interval, timeout, latency_threshold)
+        previous = _monitors.pop(alias, None)
+    if previous is not None:
+        previous.stop()
+
+
+def start_health_monitor(alias=mongoengine.DEFAULT_CONNECTION_NAME,
+                         interval=10, timeout=2, latency_threshold=None):
+    """
+    Start monitoring the health of a connection alias in the background
+    right away, replacing its previous monitor, if any. Return the
+    monitor.
+    """
+    monitor_health(alias, interval, timeout, latency_threshold)
+    return _ensure_health_monitor(alias)
+
+
+def stop_health_monitor(alias=mongoengine.DEFAULT_CONNECTION_NAME):
+    """Stop monitoring the health of a connection alias."""
+    with _monitors_lock:
+        _monitor_settings.pop(alias, None)
+        monitor = _monitors.pop(alias, None)
+    if monitor is not None:
+        monitor.stop()
+
+
+def _ensure_health_monitor(alias):
+    """
+    Return the health monitor of a connection alias in the current
+    process, starting it if the alias is monitored, or None.
+    """
+    monitor = _monitors.get(alias)
+    if monitor is not None and monitor.pid == os.getpid():
+        return monitor
+    if alias not in _monitor_settings:
+        return None
+
+    with _monitors_lock:
+        monitor = _monitors.get(alias)
+        settings = _monitor_settings.get(alias)
+        if (monitor is None or monitor.pid != os.getpid()) and settings is not None:
+            monitor = _monitors[alias] = HealthMonitor(alias, *settings)
+            monitor.start()
+    return monitor
+
+
+def get_health_monitor(alias=mongoengine.DEFAULT_CONNECTION_NAME):
+    """Return the health monitor of a connection alias, or None."""
+    return _ensure_health_monitor(alias)
+
+
+def is_degraded(alias=mongoengine.DEFAULT_CONNECTION_NAME):
+    """
+    Return True if the health monitor of a connection alias marked it
+    degraded. Unmonitored aliases are never degraded.
+    """
+    monitor = _ensure_health_monitor(alias)
+    return monitor is not None and monitor.degraded
+
+
+def get_read_alias(alias=mongoengine.DEFAULT_CONNECTION_NAME):
+    """
+    Return the alias reads of the given alias should go to, i.e. its
+    fallback alias while it's degraded and the fallback isn't, or the
+    alias itself otherwise.
+    """
+    fallback = _fallbacks.get(alias)
+    if fallback is not None and is_degraded(alias) and not is_degraded(fallback):
+        return fallback
+    return alias
@@ -0,0 +1,103 @@
+from flask import current_app, g, has_app_context
+
+from .tenants import get_tenant
+
+__all__ = ('IdentityMap', 'get_identity_map')
+
+
+class IdentityMap(object):
+    """
+    Keeps the documents loaded by their primary key during a Flask app
+    context, so that loading the same document again returns the
+    instance which is already in memory instead of querying MongoDB.
+    """
+
+    def __init__(self):
+        self._documents = {}
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def _collection_key(document_cls):
+        return (get_tenant(document_cls) or document_cls._meta.get('db_alias'),
+                document_cls._get_collection_name())
+
+    def get(self, document_cls, pk):
+        """
+        Return the instance of `document_cls` with the given primary key
+        if it has already been loaded, or None otherwise.
+        """
+        key = self._collection_key(document_cls) + (pk,)
+        try:
+            doc = self._documents.get(key)
+        except TypeError:
+            # Unhashable primary key
+            doc = None
+
+        # Documents sharing a collection through inheritance also share
+        # keys, so make sure we're handing out the right class.
+        if doc is None or not isinstance(doc, document_cls):
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        return doc
+
+    def add(self, doc):
+        """Remember a loaded document."""
+        if doc is None or doc.pk is None:
+            return
+        key = self._collection_key(doc.__class__) + (doc.pk,)
+        try:
+            self._documents[key] = doc
+        except TypeError:
+            pass
+
+    def remove(self, doc):
+        """Forget a document."""
+        key = self._collection_key(doc.__class__) + (doc.pk,)
+        try:
+            self._documents.pop(key, None)
+        except TypeError:
+            pass
+
+    def discard(self, document_cls):
+        """Forget all the documents stored in a collection."""
+        collection_key = self._collection_key(document_cls)
+        for key in list(self._documents):
+            if key[:2] == collection_key:
+                del self._documents[key]
+
+    def clear(self):
+        """Forget all the documents."""
+        self._documents.clear()
+
+    def __len__(self):
+        return len(self._documents)
+
+    @property
+    def stats(self):
+        """Dict of the hit and miss counters and the number of documents."""
+        return {'hits': self.hits, 'misses': self.misses, 'size': len(self)}
+
+
+def get_identity_map():
+    """
+    Return the identity map of the current app context, or None if
+    there's no app context or "MONGODB_IDENTITY_MAP" isn't enabled in
+    the app config.
+    """
+    if not has_app_context() or not current_app.config.get('MONGODB_IDENTITY_MAP'):
+        return None
+
+    identity_map = getattr(g, '_mongoengine_identity_map', None)
+    if identity_map is None:
+        identity_map = g._mongoengine_identity_map = IdentityMap()
+    return identity_map
+
+
+def _teardown_identity_map(exception=None):
+    """Drop the identity map at the end of an app context."""
+    if hasattr(g, '_mongoengine_identity_map'):
+        g._mongoengine_identity_map.clear()
+        del g._mongoengine_identity_map
@@ -1,21 +1,410 @@
-from bson import json_util
+import calendar
+import datetime
+import functools
+
+from bson import ObjectId, json_util
+import flask
+from flask import current_app, stream_with_context
 from flask.json import JSONEncoder
 from mongoengine.base import BaseDocument
+from mongoengine.fields import (BooleanField, DateTimeField,
+                                EmbeddedDocumentField, FloatField, IntField,
+                                ObjectIdField, ReferenceField, StringField)
 from mongoengine.queryset import QuerySet
+import six
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
+__all__ = ('jsonify', 'jsonify_stream')
+
+
+# Fields whose values are stored as they are if they have the right type
+_PRIMITIVE_FIELDS = (
+    (BooleanField, (bool,)),
+    (IntField, six.integer_types),
+    (FloatField, (float,)),
+    (StringField, (six.text_type,)),
+)
+
+
+class _JSONMode(object):
+    """
+    How BSON values are converted to JSON: as bson.json_util does by
+    default (None), as "legacy", "relaxed" or "canonical" extended JSON,
+    or as "plain" JSON, where ObjectIds are strings and dates ISO 8601
+    strings or milliseconds since the epoch (`date_format` "iso" or
+    "millis").
+    """
+
+    def __init__(self, name=None, date_format='iso'):
+        if name not in (None, 'legacy', 'relaxed', 'canonical', 'plain'):
+            raise ValueError('Unknown JSON mode: %s' % name)
+        if date_format not in ('iso', 'millis'):
+            raise ValueError('Unknown JSON date format: %s' % date_format)
+        self.name = name
+        self.date_format = date_format
+
+        # TODO remove the check once PyMongo < 3.5 support is dropped
+        self.options = None
+        if name is not None and hasattr(json_util, 'JSONMode'):
+            self.options = {
+                'legacy': json_util.LEGACY_JSON_OPTIONS,
+                'relaxed': json_util.RELAXED_JSON_OPTIONS,
+                'canonical': json_util.CANONICAL_JSON_OPTIONS,
+                'plain': json_util.RELAXED_JSON_OPTIONS,
+            }[name]
+        elif name in ('legacy', 'relaxed', 'canonical'):
+            raise RuntimeError('You need PyMongo 3.5+ installed to use the %s JSON mode.' % name)
+
+        # Fields whose values can be passed through as they are, which
+        # numbers can't be in canonical mode nor NaN/Infinity in the modes
+        # based on relaxed extended JSON
+        self.primitive_fields = _PRIMITIVE_FIELDS
+        if name in ('relaxed', 'plain'):
+            self.primitive_fields = _PRIMITIVE_FIELDS[:2] + _PRIMITIVE_FIELDS[3:]
+        elif name == 'canonical':
+            self.primitive_fields = (_PRIMITIVE_FIELDS[0], _PRIMITIVE_FIELDS[3])
+
+    def default(self, obj):
+        """Same as json_util.default, in this mode."""
+        if self.name == 'plain':
+            if isinstance(obj, ObjectId):
+                return str(obj)
+            if isinstance(obj, datetime.datetime):
+                return self._format_date(obj)
+        if self.options is None:
+            return json_util.default(obj)
+        return json_util.default(obj, self.options)
+
+    def convert(self, obj):
+        """Same as json_util._json_convert, in this mode."""
+        if self.options is None and self.name != 'plain':
+            return json_util._json_convert(obj)
+        if self.name != 'plain':
+            return json_util._json_convert(obj, self.options)
+
+        if hasattr(obj, 'items'):
+            return dict((k, self.convert(v)) for k, v in obj.items())
+        elif hasattr(obj, '__iter__') and not isinstance(obj, (six.text_type, bytes)):
+            return [self.convert(v) for v in obj]
+        try:
+            return self.default(obj)
+        except TypeError:
+            return obj
+
+    def _format_date(self, value):
+        if value.utcoffset() is not None:
+            value = value - value.utcoffset()
+        millis = calendar.timegm(value.timetuple()) * 1000 + value.microsecond // 1000
+        if self.date_format == 'millis':
+            return millis
+        return '%s.%03dZ' % (value.strftime('%Y-%m-%dT%H:%M:%S'), millis % 1000)
+
+
+# Modes by (name, date format)
+_modes = {}
+
+
+def _json_mode(name=None, date_format=None):
+    """Return the (shared) JSON mode with the given name and date format."""
+    key = (name, date_format or 'iso')
+    mode = _modes.get(key)
+    if mode is None:
+        mode = _modes[key] = _JSONMode(*key)
+    return mode
+
+
+def _is_field(field, field_cls):
+    """
+    Return whether a field is a `field_cls` storing its values the same
+    way, i.e. whose class doesn't override to_mongo nor to_python (which
+    the default to_mongo goes through).
+    """
+    if not isinstance(field, field_cls):
+        return False
+    for name in ('to_mongo', 'to_python'):
+        if (six.get_unbound_function(getattr(type(field), name)) is not
+                six.get_unbound_function(getattr(field_cls, name))):
+            return False
+    return True
+
+
+def _field_converter(field, mode):
+    """
+    Return the function converting the values of a field to what
+    mode.convert(field.to_mongo(value)) would return, using a shortcut
+    for the common types.
+    """
+    for field_cls, types in mode.primitive_fields:
+        if _is_field(field, field_cls):
+            def convert(value):
+                if type(value) in types:
+                    return value
+                return mode.convert(field.to_mongo(value))
+            return convert
+
+    if _is_field(field, DateTimeField):
+        def convert(value):
+            if isinstance(value, datetime.datetime):
+                return mode.default(value)
+            return mode.convert(field.to_mongo(value))
+    elif _is_field(field, ObjectIdField):
+        def convert(value):
+            if isinstance(value, ObjectId):
+                return mode.default(value)
+            return mode.convert(field.to_mongo(value))
+    elif isinstance(field, ReferenceField):
+        def convert(value):
+            value = field.to_mongo(value)
+            if isinstance(value, ObjectId):
+                return mode.default(value)
+            return mode.convert(value)
+    elif _is_field(field, EmbeddedDocumentField):
+        convert = functools.partial(_document_to_json, mode=mode)
+    else:
+        def convert(value):
+            return mode.convert(field.to_mongo(value))
+    return convert
+
+
+def _view_fields(document_cls, view):
+    """
+    Return the names of the fields of a document class in the given JSON
+    view (as listed in its meta['json_views']), or all of them for None.
+    """
+    if view is None:
+        return document_cls._fields_ordered
+    try:
+        names = document_cls._meta.get('json_views', {})[view]
+    except KeyError:
+        raise ValueError('%s has no %r JSON view' % (document_cls.__name__, view))
+
+    unknown = set(names) - set(document_cls._fields)
+    if unknown:
+        raise ValueError('Unknown fields in the %r JSON view of %s: %s' % (
+            view, document_cls.__name__, ', '.join(sorted(unknown))))
+    return names
+
+
+def _view_keys(document_cls, view):
+    """Return the set of keys of the stored documents in a JSON view."""
+    keys = set(document_cls._fields[name].db_field
+               for name in _view_fields(document_cls, view))
+    keys.add('_cls')
+    return keys
+
+
+def _compile_serializer(document_cls, view=None, mode=None):
+    """
+    Return a function converting the documents of a class to JSON-ready
+    values in the given JSON mode, or None for documents which have to go through to_mongo()
+    (dynamic documents and documents with self generating fields).
+    """
+    if document_cls._dynamic:
+        return None
+    mode = mode or _json_mode()
+
+    fields = []
+    for name in document_cls._fields_ordered:
+        field = document_cls._fields[name]
+        if field._auto_gen:
+            return None
+        fields.append((name, field.db_field, _field_converter(field, mode), field.null))
+
+    # Only keep the fields of the view, if any
+    names = _view_fields(document_cls, view)
+    fields = [f for f in fields if f[0] in names]
 
+    # Same order as to_mongo: _id, _cls and the other fields
+    id_fields = [f for f in fields if f[1] == '_id']
+    other_fields = [f for f in fields if f[1] != '_id']
+    class_name = None
+    if document_cls._meta.get('allow_inheritance'):
+        class_name = document_cls._class_name
 
-def _make_encoder(superclass):
+    def convert_fields(result, data, fields):
+        for name, db_field, convert, null in fields:
+            value = data.get(name)
+            if value is not None:
+                result[db_field] = convert(value)
+            elif null:
+                result[db_field] = None
+
+    def serialize(doc):
+        result = {}
+        convert_fields(result, doc._data, id_fields)
+        if class_name is not None:
+            result['_cls'] = class_name
+        convert_fields(result, doc._data, other_fields)
+        return result
+    return serialize
+
+
+def _document_to_json(doc, view=None, mode=None):
+    """
+    Convert a document to JSON-ready values with the serializer of its
+    class for the given view and JSON mode, which is compiled on first
+    use and cached on the class.
+    """
+    mode = mode or _json_mode()
+    document_cls = doc.__class__
+    serializers = document_cls.__dict__.get('_json_serializers')
+    if serializers is None:
+        serializers = document_cls._json_serializers = {}
+    try:
+        serialize = serializers[view, mode]
+    except KeyError:
+        serialize = serializers[view, mode] = _compile_serializer(document_cls, view, mode)
+
+    if serialize is not None:
+        return serialize(doc)
+
+    son = doc.to_mongo()
+    if view is not None:
+        keys = _view_keys(document_cls, view)
+        son = dict((k, v) for k, v in son.items() if k in keys)
+    return mode.convert(son)
+
+
+def _queryset_to_json(queryset, view, mode):
+    """
+    Convert the documents of a QuerySet to JSON-ready values with the
+    given view, only fetching the fields of the view.
+    """
+    keys = _view_keys(queryset._document, view)
+    queryset = queryset.only(*_view_fields(queryset._document, view))
+    return [mode.convert(dict((k, v) for k, v in son.items() if k in keys))
+            for son in queryset.as_pymongo()]
+
+
+def _apply_view(obj, view, mode):
+    if isinstance(obj, BaseDocument):
+        return _document_to_json(obj, view, mode)
+    if isinstance(obj, QuerySet):
+        return _queryset_to_json(obj, view, mode)
+    if isinstance(obj, (list, tuple)):
+        return [_apply_view(item, view, mode) for item in obj]
+    return obj
+
+
+def _orjson_dumps(obj, default, sort_keys, indent):
+    if indent not in (None, 2):
+        return None
+    option = (orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_PASSTHROUGH_DATACLASS |
+              orjson.OPT_NON_STR_KEYS)
+    if sort_keys:
+        option |= orjson.OPT_SORT_KEYS
+    if indent:
+        option |= orjson.OPT_INDENT_2
+    return orjson.dumps(obj, default=default, option=option).decode('utf-8')
+
+
+def _ujson_dumps(obj, default, sort_keys, indent):
+    # ujson loses the contents of the dicts returned by default() when
+    # sorting keys
+    if sort_keys:
+        return None
+    return ujson.dumps(obj, default=default, indent=indent or 0,
+                       escape_forward_slashes=False)
+
+
+def _json_backend(name):
+    """
+    Return the dumps function of a JSON library given its name ("orjson",
+    "ujson" or "auto" for the first of them which is installed), or None
+    to use the standard library.
+    """
+    if name is None:
+        return None
+    if name == 'auto':
+        if orjson is not None:
+            return _orjson_dumps
+        if ujson is not None:
+            return _ujson_dumps
+        return None
+    if name not in ('orjson', 'ujson'):
+        raise ValueError('Unknown JSON backend: %s' % name)
+    if globals()[name] is None:
+        raise RuntimeError('You need %s installed to use it as the JSON backend.' % name)
+    return _orjson_dumps if name == 'orjson' else _ujson_dumps
+
+
+def _iterencode_queryset(encoder, queryset, batch_size, view=None):
+    """
+    Yield the JSON array of the documents of a QuerySet in chunks of
+    `batch_size` documents, fetching them from the cursor batch by batch
+    rather than loading them all. Only the fields of the JSON `view` are
+    fetched and encoded, if one is given.
+    """
+    keys = None
+    if view is not None:
+        keys = _view_keys(queryset._document, view)
+        queryset = queryset.only(*_view_fields(queryset._document, view))
+    cursor = queryset.clone().batch_size(batch_size)._cursor
+    separator = ''
+    batch = []
+
+    yield '['
+    for son in cursor:
+        if keys is not None:
+            son = dict((k, v) for k, v in son.items() if k in keys)
+        batch.append(encoder.encode(encoder.json_mode.convert(son)))
+        if len(batch) >= batch_size:
+            yield separator + ','.join(batch)
+            separator = ','
+            batch = []
+    if batch:
+        yield separator + ','.join(batch)
+    yield ']'
+
+
+def _make_encoder(superclass, backend=None, mode=None):
     class MongoEngineJSONEncoder(superclass):
         """
         A JSONEncoder which provides serialization of MongoEngine
         documents and queryset objects.
         """
+
+        # Number of documents fetched (and yielded) at once by iterencode,
+        # and the JSON view it encodes them with
+        batch_size = 1000
+        view = None
+
+        # How the BSON values of the documents are converted
+        json_mode = mode or _json_mode()
+
         def default(self, obj):
             if isinstance(obj, BaseDocument):
-                return json_util._json_convert(obj.to_mongo())
+                return _document_to_json(obj, mode=self.json_mode)
             elif isinstance(obj, QuerySet):
-                return json_util._json_convert(obj.as_pymongo())
+                return self.json_mode.convert(obj.as_pymongo())
             return superclass.default(self, obj)
+
+        def encode(self, o):
+            # Use the faster JSON library if there's one, and leave it to
+            # the standard library to report errors.
+            if backend is not None:
+                try:
+                    result = backend(o, self.default, self.sort_keys, self.indent)
+                except TypeError:
+                    result = None
+                if result is not None:
+                    return result
+            return superclass.encode(self, o)
+
+        def iterencode(self, o, _one_shot=False):
+            # Stream QuerySets instead of loading all of their documents
+            if isinstance(o, QuerySet):
+                return _iterencode_queryset(self, o, self.batch_size, self.view)
+            return superclass.iterencode(self, o, _one_shot)
     return MongoEngineJSONEncoder
 
 
@@ -32,5 +421,45 @@ def override_json_encoder(app):
 
     NOTE: This does not cover situations where users override
     an instance's json_encoder after calling init_app.
+
+    The "MONGODB_JSON_BACKEND" config var may name a faster JSON library
+    to encode with ("orjson", "ujson" or "auto"), and "MONGODB_JSON_MODE"
+    how BSON values are converted ("legacy", "relaxed", "canonical" or
+    "plain", with dates formatted as per "MONGODB_JSON_DATE_FORMAT").
+    """
+    backend = _json_backend(app.config.get('MONGODB_JSON_BACKEND'))
+    mode = _json_mode(app.config.get('MONGODB_JSON_MODE'),
+                      app.config.get('MONGODB_JSON_DATE_FORMAT'))
+    app.json_encoder = _make_encoder(app.json_encoder, backend, mode)
+
+
+def jsonify(*args, **kwargs):
+    """
+    Same as flask.jsonify, but the documents and QuerySets passed to it
+    (or lists of them) can be encoded with one of their JSON views, e.g.
+    jsonify(post, view='summary') for a document class with
+    meta = {'json_views': {'summary': ['id', 'title']}}. Only the fields
+    of the view are fetched from QuerySets.
+    """
+    view = kwargs.pop('view', None)
+    if view is not None:
+        mode = getattr(current_app.json_encoder, 'json_mode', None) or _json_mode()
+        args = [_apply_view(arg, view, mode) for arg in args]
+        kwargs = dict((k, _apply_view(v, view, mode)) for k, v in kwargs.items())
+    return flask.jsonify(*args, **kwargs)
+
+
+def jsonify_stream(queryset, batch_size=1000, view=None):
+    """
+    Return a streamed response with the JSON array of the documents of a
+    QuerySet, encoded as they're fetched from MongoDB `batch_size` at a
+    time, so that the memory used doesn't grow with the number of
+    documents. Only the fields of the JSON `view` are fetched and
+    encoded, if one is given.
     """
-    app.json_encoder = _make_encoder(app.json_encoder)
+    encoder = current_app.json_encoder()
+    encoder.batch_size = batch_size
+    encoder.view = view
+    return current_app.response_class(
+        stream_with_context(encoder.iterencode(queryset)),
+        mimetype='application/json')
@@ -1,50 +1,350 @@
 # -*- coding: utf-8 -*-
+import base64
+import binascii
 import math
-from flask import abort
+import time
+
+from bson import BSON, DBRef, json_util
+from bson.errors import BSONError
+from flask import abort, current_app, has_app_context
+import mongoengine
+from mongoengine.base import BaseDocument
 from mongoengine.queryset import QuerySet
+import pymongo
+
+__all__ = ("Pagination", "ListFieldPagination", "KeysetPagination")
+
+
+COUNT_MODES = ('exact', 'estimated', 'cached', 'none')
+
+# Totals remembered by the "cached" count mode outside of an app
+# context, keyed by connection alias, collection and query spec:
+# {key: (counted_at, total)}. Each app has its own in its state.
+_count_cache = {}
+_COUNT_CACHE_MAX_SIZE = 1000
+
+
+def _get_count_cache():
+    """Return the totals remembered for the current app, if any."""
+    if has_app_context():
+        for state in current_app.extensions.get('mongoengine', {}).values():
+            if state.get('counts') is not None:
+                return state['counts']
+    return _count_cache
+
+
+def _cached_count(queryset, ttl):
+    """Return the count of a QuerySet, reusing a total computed for the
+    same query spec in the last `ttl` seconds.
+    """
+    alias = (queryset._document._meta.get('db_alias') or
+             mongoengine.DEFAULT_CONNECTION_NAME)
+    key = (alias, queryset._collection.full_name,
+           json_util.dumps(queryset._query, sort_keys=True))
+    now = time.time()
+    counts = _get_count_cache()
+
+    cached = counts.get(key)
+    if cached is not None and now - cached[0] < ttl:
+        return cached[1]
+
+    if len(counts) >= _COUNT_CACHE_MAX_SIZE:
+        # Other threads may be evicting the same entries
+        for k, (counted_at, _) in list(counts.items()):
+            if now - counted_at >= ttl:
+                counts.pop(k, None)
+        if len(counts) >= _COUNT_CACHE_MAX_SIZE:
+            counts.clear()
+
+    total = queryset.count()
+    counts[key] = (now, total)
+    return total
+
+
+def _estimated_count(queryset):
+    """Return the count of a QuerySet from the collection metadata if
+    it's unfiltered, falling back to an exact count otherwise.
+    """
+    if queryset._query:
+        return queryset.count()
+
+    collection = queryset._collection
+    # TODO remove once PyMongo < 3.7 support is dropped
+    if hasattr(collection, 'estimated_document_count'):
+        return collection.estimated_document_count()
+    return collection.count()
 
-__all__ = ("Pagination", "ListFieldPagination")
+
+def _referenced_document_type(field):
+    """Return the document class referenced by a ReferenceField, or a
+    ListField of ReferenceFields, or None for any other field.
+    """
+    field = getattr(field, 'field', None) or field
+    document_type = getattr(field, 'document_type', None)
+    if getattr(document_type, '_is_document', False):
+        return document_type
+    return None
+
+
+def _find_references(documents, names):
+    """Look through the given fields of the documents and return:
+
+    * {collection name: (document class, set of ids)} of the references
+      which need to be fetched,
+    * (data dict, field name) pairs of the fields holding them,
+    * {field name: embedded documents} found in the fields,
+    * {field name: already dereferenced documents} found in the fields.
+    """
+    references = {}
+    slots = []
+    embedded = {}
+    resolved = {}
+
+    for doc in documents:
+        for name in names:
+            field = doc._fields.get(name)
+            value = doc._data.get(name)
+            if field is None or value is None:
+                continue
+
+            document_type = _referenced_document_type(field)
+            if document_type is not None:
+                slots.append((doc._data, name))
+
+            values = value if isinstance(value, list) else [value]
+            for item in values:
+                if isinstance(item, DBRef) and document_type is not None:
+                    references.setdefault(
+                        item.collection, (document_type, set())
+                    )[1].add(item.id)
+                elif getattr(item, '_is_document', False):
+                    resolved.setdefault(name, []).append(item)
+                elif isinstance(item, BaseDocument):
+                    embedded.setdefault(name, []).append(item)
+
+    return references, slots, embedded, resolved
+
+
+def _dereference_fields(documents, paths, max_depth=1):
+    """Replace the references found at the given field paths of the
+    documents with the documents they point to.
+
+    Paths are dot-separated field names which may go through embedded
+    documents and references, e.g. 'author' or 'comments.author.company'.
+    No more than `max_depth` references are followed along any path.
+    All the references on the same level are fetched with one query per
+    collection, and nothing outside of the paths is dereferenced.
+    """
+    if max_depth < 1 or not documents or not paths:
+        return
+
+    subpaths = {}
+    for path in paths:
+        name, _, rest = path.partition('.')
+        subpaths.setdefault(name, [])
+        if rest:
+            subpaths[name].append(rest)
+
+    references, slots, embedded, resolved = _find_references(documents,
+                                                             subpaths)
+
+    fetched = {}
+    for collection_name, (document_type, ids) in references.items():
+        collection = document_type._get_collection()
+        for son in collection.find({'_id': {'$in': list(ids)}}):
+            fetched[(collection_name, son['_id'])] = \
+                document_type._from_son(son)
+
+    def lookup(item):
+        if isinstance(item, DBRef):
+            return fetched.get((item.collection, item.id), item)
+        return item
+
+    for data, name in slots:
+        value = data[name]
+        if isinstance(value, list):
+            # Build a new list rather than assigning items in place, which
+            # would mark the field as changed.
+            value = [lookup(item) for item in value]
+            targets = value
+        else:
+            value = lookup(value)
+            targets = [value]
+        data[name] = value
+        resolved.setdefault(name, []).extend(
+            doc for doc in targets if getattr(doc, '_is_document', False))
+
+    for name, rest in subpaths.items():
+        if not rest:
+            continue
+        _dereference_fields(embedded.get(name), rest, max_depth)
+        _dereference_fields(resolved.get(name), rest, max_depth - 1)
 
 
 class Pagination(object):
 
-    def __init__(self, iterable, page, per_page):
+    def __init__(self, iterable, page, per_page, count='exact',
+                 count_ttl=60, total=None, lazy=False, batch_size=100,
+                 select_related=True, max_depth=1):
+        """Paginates a QuerySet or any other sliceable iterable.
+
+        Count controls how the total number of items is obtained for
+        a QuerySet:
 
+        * 'exact' - run a count query every time (the default).
+        * 'estimated' - read the total from the collection metadata if
+          the QuerySet is unfiltered, and count exactly otherwise.
+        * 'cached' - reuse a count of the same query made within the
+          last `count_ttl` seconds.
+        * 'none' - don't count at all. One extra item is fetched to find
+          out whether there's a next page, and `total` is None.
+
+        Total can be passed in if it's already known, in which case no
+        counting happens regardless of the count mode.
+
+        If lazy is True and the iterable is a QuerySet, `items` is an
+        iterator which fetches documents from the database and
+        dereferences them `batch_size` at a time, rather than a list of
+        the whole page. It can only be consumed once, but it can be
+        passed straight to a streaming response.
+
+        By default every reference of the documents on the page is
+        dereferenced up to `max_depth` levels deep. Select_related can
+        instead be a list of field paths (e.g. ['author', 'tags']) to
+        dereference only those references, or False to leave the
+        references alone until they're accessed.
+        """
         if page < 1:
             abort(404)
 
+        if count not in COUNT_MODES:
+            raise ValueError('count must be one of %s' % ', '.join(COUNT_MODES))
+
+        if lazy and count == 'none' and total is None:
+            raise ValueError('lazy pagination requires the total to be '
+                             'counted')
+
         self.iterable = iterable
         self.page = page
         self.per_page = per_page
+        self.count_mode = count
+        self.count_ttl = count_ttl
+        self.lazy = lazy
+        self.batch_size = batch_size
+        self.select_related = select_related
+        self.max_depth = max_depth
+        self._prev = None
+        self._next = None
 
-        if isinstance(iterable, QuerySet):
-            self.total = iterable.count()
-        else:
+        is_queryset = isinstance(iterable, QuerySet)
+        if total is not None:
+            self.total = total
+        elif not is_queryset:
             self.total = len(iterable)
+        elif count == 'estimated':
+            self.total = _estimated_count(iterable)
+        elif count == 'cached':
+            self.total = _cached_count(iterable, count_ttl)
+        elif count == 'none':
+            self.total = None
+        else:
+            self.total = iterable.count()
 
         start_index = (page - 1) * per_page
         end_index = page * per_page
+        if self.total is None:
+            end_index += 1
+
+        self._has_more = False
+
+        if lazy and is_queryset:
+            if page != 1 and start_index >= self.total:
+                abort(404)
+            self.items = self._iter_items(iterable[start_index:end_index])
+            return
 
         self.items = iterable[start_index:end_index]
         if isinstance(self.items, QuerySet):
-            self.items = self.items.select_related()
+            self.items = self._dereference(self.items, list(self.items))
+
+        if self.total is None:
+            self.items = list(self.items)
+            self._has_more = len(self.items) > per_page
+            self.items = self.items[:per_page]
+
         if not self.items and page != 1:
             abort(404)
 
+    def _iter_items(self, queryset):
+        """Yield the documents of a QuerySet, fetching them from the
+        database and dereferencing their references a batch at a time.
+        """
+        # Don't let the QuerySet hold on to the documents we've already
+        # handed out.
+        if hasattr(queryset, 'no_cache'):
+            queryset = queryset.no_cache()
+
+        batch = []
+        for doc in queryset.batch_size(self.batch_size):
+            batch.append(doc)
+            if len(batch) >= self.batch_size:
+                for doc in self._dereference(queryset, batch):
+                    yield doc
+                batch = []
+        if batch:
+            for doc in self._dereference(queryset, batch):
+                yield doc
+
+    def _dereference(self, queryset, documents):
+        """Dereference the references of a list of documents coming from
+        a QuerySet, as configured by `select_related`.
+        """
+        if queryset._as_pymongo:
+            return documents
+        if self.select_related is True:
+            # Same as QuerySet.select_related(max_depth)
+            return queryset._dereference(documents,
+                                         max_depth=self.max_depth + 1)
+        if self.select_related:
+            _dereference_fields(documents, self.select_related,
+                                self.max_depth)
+        return documents
+
     @property
     def pages(self):
-        """The total number of pages"""
+        """The total number of pages. If the total isn't known, this is
+        the number of pages known to exist so far."""
+        if self.total is None:
+            return self.page + 1 if self._has_more else self.page
         return int(math.ceil(self.total / float(self.per_page)))
 
-    def prev(self, error_out=False):
-        """Returns a :class:`Pagination` object for the previous page."""
+    def _paginate(self, page):
+        """Return a new :class:`Pagination` object for a given page of
+        the same iterable, reusing the total that's already known.
+        """
         assert self.iterable is not None, ('an object is required '
                                            'for this method to work')
         iterable = self.iterable
         if isinstance(iterable, QuerySet):
+            # Work on a copy so that the original QuerySet isn't changed
+            # under the feet of whoever else holds a reference to it.
+            iterable = iterable.clone()
             iterable._skip = None
             iterable._limit = None
-        return self.__class__(iterable, self.page - 1, self.per_page)
+        return self.__class__(iterable, page, self.per_page, self.count_mode,
+                              self.count_ttl, total=self.total,
+                              lazy=self.lazy, batch_size=self.batch_size,
+                              select_related=self.select_related,
+                              max_depth=self.max_depth)
+
+    def prev(self, error_out=False):
+        """Returns a :class:`Pagination` object for the previous page.
+        The page is fetched on first access and reused afterwards.
+        """
+        if self._prev is None:
+            self._prev = self._paginate(self.page - 1)
+            self._prev._next = self
+        return self._prev
 
     @property
     def prev_num(self):
@@ -57,14 +357,13 @@ class Pagination(object):
         return self.page > 1
 
     def next(self, error_out=False):
-        """Returns a :class:`Pagination` object for the next page."""
-        assert self.iterable is not None, ('an object is required '
-                                           'for this method to work')
-        iterable = self.iterable
-        if isinstance(iterable, QuerySet):
-            iterable._skip = None
-            iterable._limit = None
-        return self.__class__(iterable, self.page + 1, self.per_page)
+        """Returns a :class:`Pagination` object for the next page.
+        The page is fetched on first access and reused afterwards.
+        """
+        if self._next is None:
+            self._next = self._paginate(self.page + 1)
+            self._next._prev = self
+        return self._next
 
     @property
     def has_next(self):
@@ -127,8 +426,10 @@ class ListFieldPagination(Pagination):
         paginating, and doc_id should be it's _id.
         Field name is the name of the array we're paginating.
         Page and per_page work just like in Pagination.
-        Total is an argument because it can be computed more efficiently
-        elsewhere, but we still use array.length as a fallback.
+        Total is an argument because it may already be known, otherwise
+        the size of the array is computed by the database in the same
+        aggregation that fetches the page, so the whole array is never
+        transferred.
         """
         if page < 1:
             abort(404)
@@ -139,29 +440,232 @@ class ListFieldPagination(Pagination):
         self.queryset = queryset
         self.doc_id = doc_id
         self.field_name = field_name
+        self._prev = None
+        self._next = None
 
         start_index = (page - 1) * per_page
 
-        field_attrs = {field_name: {"$slice": [start_index, per_page]}}
+        document = queryset._document
+        db_field = document._translate_field_name(field_name)
+        array = {'$ifNull': ['$' + db_field, []]}
 
-        qs = queryset(pk=doc_id)
-        self.items = getattr(qs.fields(**field_attrs).first(), field_name)
-        self.total = total or len(getattr(qs.fields(**{field_name: 1}).first(),
-                                          field_name))
+        projection = {db_field: {'$slice': [array, start_index, per_page]},
+                      '_cls': 1}
+        if not total:
+            projection['_total'] = {'$size': array}
+
+        pipeline = [{'$match': queryset(pk=doc_id)._query},
+                    {'$project': projection}]
+        result = queryset._collection.aggregate(pipeline)
+        # TODO remove once PyMongo < 3.0 support is dropped
+        if isinstance(result, dict):
+            result = result['result']
+        result = list(result)
+        if not result:
+            abort(404)
+
+        son = result[0]
+        self.total = total or son.pop('_total')
+        self.items = getattr(document._from_son(son), field_name)
 
         if not self.items and page != 1:
             abort(404)
 
-    def prev(self, error_out=False):
-        """Returns a :class:`Pagination` object for the previous page."""
+    def _paginate(self, page):
+        """Return a new :class:`ListFieldPagination` object for a given
+        page of the same array.
+        """
         assert self.items is not None, ('a query object is required '
                                         'for this method to work')
         return self.__class__(self.queryset, self.doc_id, self.field_name,
-                              self.page - 1, self.per_page, self.total)
+                              page, self.per_page, self.total)
+
+
+class KeysetPagination(object):
+
+    def __init__(self, queryset, per_page, cursor=None, sort=None):
+        """Paginates a QuerySet by seeking past the last seen document
+        instead of skipping over all the preceding ones.
+
+        The position of a page is described by an opaque cursor string
+        rather than a page number, so every page costs the same no
+        matter how deep it is. Sort is a list of MongoEngine-style sort
+        keys (e.g. ['-created', 'title']); the primary key is always
+        appended as a tie-breaker so that the ordering is total. Pass
+        `next_cursor` or `prev_cursor` of a page back in as `cursor`
+        to move forward or backward.
+        """
+        if per_page < 1:
+            abort(404)
+
+        self.queryset = queryset
+        self.per_page = per_page
+        self.cursor = cursor
+        self.sort = self._normalize_sort(sort)
+
+        self._keys = queryset._get_order_by(self.sort)
+        self._check_projection()
+
+        backwards = False
+        values = None
+        if cursor:
+            backwards, values = self._decode_cursor(cursor)
+
+        sort = self.sort
+        if backwards:
+            sort = [self._invert_key(key) for key in sort]
+
+        qs = queryset.clone().order_by(*sort)
+        if values is not None:
+            qs = qs.filter(__raw__=self._seek_query(values, backwards))
+
+        items = list(qs.limit(per_page + 1).select_related())
+        has_more = len(items) > per_page
+        items = items[:per_page]
+
+        if backwards:
+            items.reverse()
+            self.has_prev = has_more
+            self.has_next = True
+        else:
+            # Anything we've seeked past is assumed to still be there,
+            # which saves a query looking backwards.
+            self.has_prev = values is not None
+            self.has_next = has_more
+
+        self.items = items
+
+    @staticmethod
+    def _normalize_sort(sort):
+        """Return a list of sort keys ending with the primary key."""
+        if sort is None:
+            sort = []
+        elif not isinstance(sort, (list, tuple)):
+            sort = [sort]
+        sort = [key for key in sort if key]
+
+        names = [key.lstrip('+-') for key in sort]
+        if not set(names) & set(['pk', 'id', '_id']):
+            direction = '-' if sort and sort[-1].startswith('-') else '+'
+            sort.append(direction + 'pk')
+        return sort
+
+    @staticmethod
+    def _invert_key(key):
+        if key.startswith('-'):
+            return '+' + key[1:]
+        return '-' + key.lstrip('+')
+
+    def _check_projection(self):
+        """Make sure the documents will have their sort key values, as
+        the cursors are made out of them.
+        """
+        projection = self.queryset._loaded_fields.as_dict()
+        only = set(k for k, v in projection.items() if v == 1)
+        excluded = set(k for k, v in projection.items() if v == 0)
+        for key, _ in self._keys:
+            parts = key.split('.')
+            prefixes = set('.'.join(parts[:i + 1]) for i in range(len(parts)))
+            if key == '_id':
+                loaded = key not in excluded
+            else:
+                loaded = (not only or prefixes & only) and not prefixes & excluded
+            if not loaded:
+                raise ValueError('Sort key %s is excluded from the QuerySet '
+                                 'being paginated' % key)
+
+    def _seek_query(self, values, backwards):
+        """Build a raw query matching the documents which come strictly
+        after (or before, going backwards) the given sort key values.
+
+        Null (or missing) values sort before any other value, which
+        comparison operators don't match, so they're bracketed
+        explicitly.
+        """
+        clauses = []
+        for i, (key, direction) in enumerate(self._keys):
+            ascending = direction == pymongo.ASCENDING
+            if backwards:
+                ascending = not ascending
+            prefix = dict((k, v) for (k, _), v in zip(self._keys[:i], values))
+
+            if values[i] is None:
+                # Only non-null values come after a null one
+                conditions = [{'$ne': None}] if ascending else []
+            elif ascending:
+                conditions = [{'$gt': values[i]}]
+            else:
+                # Nulls come after any other value in descending order
+                conditions = [{'$lt': values[i]}, None]
+
+            for condition in conditions:
+                clause = dict(prefix)
+                clause[key] = condition
+                clauses.append(clause)
+        return {'$or': clauses}
+
+    def _key_values(self, doc):
+        """Return the values of the sort keys for a given document."""
+        son = doc.to_mongo()
+        values = []
+        for key, _ in self._keys:
+            value = son
+            for part in key.split('.'):
+                value = value.get(part) if value is not None else None
+            values.append(value)
+        return values
+
+    def _encode_cursor(self, doc, backwards):
+        data = BSON.encode({
+            'k': [key for key, _ in self._keys],
+            'v': self._key_values(doc),
+            'b': backwards,
+        })
+        return base64.urlsafe_b64encode(data).decode('ascii').rstrip('=')
+
+    def _decode_cursor(self, cursor):
+        try:
+            if not isinstance(cursor, bytes):
+                cursor = cursor.encode('ascii')
+            cursor += b'=' * (-len(cursor) % 4)
+            data = BSON(base64.urlsafe_b64decode(cursor)).decode()
+        except (BSONError, binascii.Error, TypeError, ValueError):
+            abort(404)
+
+        # A cursor issued for a different sort order can't be used to
+        # seek within this one.
+        keys = [key for key, _ in self._keys]
+        if data.get('k') != keys or len(data.get('v') or []) != len(keys):
+            abort(404)
+
+        return bool(data.get('b')), data['v']
+
+    @property
+    def next_cursor(self):
+        """Cursor pointing to the page after this one."""
+        if not self.has_next or not self.items:
+            return None
+        return self._encode_cursor(self.items[-1], backwards=False)
+
+    @property
+    def prev_cursor(self):
+        """Cursor pointing to the page before this one."""
+        if not self.has_prev or not self.items:
+            return None
+        return self._encode_cursor(self.items[0], backwards=True)
+
+    def prev(self, error_out=False):
+        """Returns a :class:`KeysetPagination` object for the previous
+        page.
+        """
+        if not self.has_prev:
+            abort(404)
+        return self.__class__(self.queryset, self.per_page,
+                              self.prev_cursor, self.sort)
 
     def next(self, error_out=False):
-        """Returns a :class:`Pagination` object for the next page."""
-        assert self.items is not None, ('a query object is required '
-                                        'for this method to work')
-        return self.__class__(self.queryset, self.doc_id, self.field_name,
-                              self.page + 1, self.per_page, self.total)
+        """Returns a :class:`KeysetPagination` object for the next page."""
+        if not self.has_next:
+            abort(404)
+        return self.__class__(self.queryset, self.per_page,
+                              self.next_cursor, self.sort)
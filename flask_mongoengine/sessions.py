@@ -1,36 +1,248 @@
 import datetime
+import functools
+import hashlib
+import pickle
 import sys
+import threading
+import time
 import uuid
+import zlib
 
+from bson import BSON, Binary
 from bson.tz_util import utc
 from flask.sessions import SessionInterface, SessionMixin
+from mongoengine.connection import get_db
+import pymongo
 from werkzeug.datastructures import CallbackDict
 
+from .cache import MemoryCache
+
+# TODO remove the check once PyMongo < 3.0 support is dropped
+if pymongo.version_tuple[0] >= 3:
+    from pymongo.write_concern import WriteConcern
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
 __all__ = ("MongoEngineSession", "MongoEngineSessionInterface")
 
 if sys.version_info >= (3, 0):
     basestring = str
 
+# Version of the layout of the binary session payloads
+PAYLOAD_VERSION = 1
+
+# Number of seconds after their expiration date the TTL index deletes
+# the sessions at: 31 weeks, as the index has always been created with
+TTL_INDEX_DELAY = 60 * 60 * 24 * 7 * 31
+
+
+def _serializer(name):
+    """Return the (dumps, loads) functions of a serializer given its name."""
+    if name == 'pickle':
+        return functools.partial(pickle.dumps, protocol=2), pickle.loads
+    if name == 'msgpack':
+        if msgpack is None:
+            raise RuntimeError('You need msgpack installed to serialize sessions with it.')
+        return (functools.partial(msgpack.packb, use_bin_type=True),
+                functools.partial(msgpack.unpackb, raw=False))
+    raise ValueError('Unknown session serializer: %s' % name)
+
+
+def _compressor(name):
+    """Return the (compress, decompress) functions given their name."""
+    if name is None:
+        return bytes, bytes
+    if name == 'zlib':
+        return zlib.compress, zlib.decompress
+    if name == 'zstd':
+        if zstandard is None:
+            raise RuntimeError('You need zstandard installed to compress sessions with zstd.')
+        return (zstandard.ZstdCompressor().compress,
+                zstandard.ZstdDecompressor().decompress)
+    raise ValueError('Unknown session compression: %s' % name)
+
+
+def _decode_payload(stored_session):
+    """
+    Return the data of a stored session saved as a binary payload, or
+    None if its layout is unknown.
+    """
+    if stored_session.get('version') != PAYLOAD_VERSION:
+        return None
+
+    serializer, _, compression = stored_session['encoding'].partition('+')
+    loads = _serializer(serializer)[1]
+    decompress = _compressor(compression or None)[1]
+    return loads(decompress(stored_session['payload']))
+
 
 class MongoEngineSession(CallbackDict, SessionMixin):
+    """
+    Session dict keeping track of the keys which have been changed, so
+    that only those are written back to the database.
+
+    If a `loader` is given, the stored session is only loaded on first
+    access, by calling it with the sid. It returns the stored data, its
+    expiration date and whether the whole session has to be written back
+    on save (e.g. it's stored in another format), or None if there's no
+    such (valid) session, in which case the session gets a new sid.
+    """
 
-    def __init__(self, initial=None, sid=None):
+    def __init__(self, initial=None, sid=None, loader=None):
         def on_update(self):
-            self.modified = True
+            self._modified = True
         CallbackDict.__init__(self, initial, on_update)
         self.sid = sid
-        self.modified = False
+        self.expiration = None
+        self._loader = loader
+        self._modified = False
+        self._rewrite = False
+        self._changed_keys = set()
+
+    @property
+    def loaded(self):
+        """Whether the stored session has been loaded (if there's one)."""
+        return self._loader is None
+
+    def _load(self):
+        if self._loader is None:
+            return
+
+        loader, self._loader = self._loader, None
+        stored_session = loader(self.sid)
+        if stored_session is None:
+            self.sid = str(uuid.uuid4())
+        else:
+            data, self.expiration, self._rewrite = stored_session
+            # Bypass the change tracking, nothing has changed yet
+            dict.update(self, data or {})
+
+    @property
+    def modified(self):
+        return self._modified
+
+    @modified.setter
+    def modified(self, value):
+        # Setting it by hand, e.g. after changing a list stored in the
+        # session in place, doesn't tell which key has been changed.
+        if value:
+            self._load()
+        self._modified = self._rewrite = value
+        if not value:
+            self._changed_keys.clear()
+
+    def __setitem__(self, key, value):
+        self._load()
+        self._changed_keys.add(key)
+        super(MongoEngineSession, self).__setitem__(key, value)
+
+    def __delitem__(self, key):
+        self._load()
+        self._changed_keys.add(key)
+        super(MongoEngineSession, self).__delitem__(key)
+
+    def setdefault(self, key, default=None):
+        self._load()
+        if key not in self:
+            self._changed_keys.add(key)
+        return super(MongoEngineSession, self).setdefault(key, default)
+
+    def pop(self, key, *args):
+        self._load()
+        self._changed_keys.add(key)
+        return super(MongoEngineSession, self).pop(key, *args)
+
+    def popitem(self):
+        self._load()
+        item = super(MongoEngineSession, self).popitem()
+        self._changed_keys.add(item[0])
+        return item
+
+    def update(self, *args, **kwargs):
+        self._load()
+        items = dict(*args, **kwargs)
+        self._changed_keys.update(items)
+        super(MongoEngineSession, self).update(items)
+
+    def clear(self):
+        self._load()
+        self._changed_keys.update(self)
+        super(MongoEngineSession, self).clear()
+
+    def _changes(self):
+        """
+        Return the dicts of the $set and $unset operators writing the
+        changed keys, or None if the whole session has to be written.
+        """
+        if self._rewrite:
+            return None
+
+        set_fields, unset_fields = {}, {}
+        for key in self._changed_keys:
+            if (not isinstance(key, basestring) or '.' in key or
+                    key.startswith('$')):
+                return None
+
+            if key in self:
+                set_fields['data.' + key] = self[key]
+            else:
+                unset_fields['data.' + key] = ''
+        return set_fields, unset_fields
+
+
+def _loading(name):
+    """Return a method of the session which loads it before reading it."""
+    def method(self, *args, **kwargs):
+        self._load()
+        return getattr(super(MongoEngineSession, self), name)(*args, **kwargs)
+    method.__name__ = name
+    return method
+
+
+for _name in ('__contains__', '__eq__', '__getitem__', '__iter__', '__len__',
+              '__ne__', '__repr__', 'copy', 'get', 'has_key', 'items',
+              'iteritems', 'iterkeys', 'itervalues', 'keys', 'values',
+              'viewitems', 'viewkeys', 'viewvalues'):
+    if hasattr(dict, _name):
+        setattr(MongoEngineSession, _name, _loading(_name))
 
 
 class MongoEngineSessionInterface(SessionInterface):
     """SessionInterface for mongoengine"""
 
-    def __init__(self, db, collection='session'):
+    def __init__(self, db, collection='session', cache_ttl=None,
+                 cache_size=10000, serializer=None, compression='zlib',
+                 shards=1, shard_aliases=None, ttl_index=True,
+                 auto_index=True):
         """
         The MongoSessionInterface
 
         :param db: The app's db eg: MongoEngine()
         :param collection: The session collection name defaults to "session"
+        :param cache_ttl: Number of seconds to keep the sessions read in an
+            in-process cache, which is disabled by default
+        :param cache_size: Maximum number of sessions in the cache
+        :param serializer: "pickle" or "msgpack" to store the sessions as a
+            single binary payload rather than as documents
+        :param compression: Compression of the binary payloads, "zlib"
+            (default), "zstd" or None
+        :param shards: Number of collections ("session_0", "session_1",
+            etc.) to spread the sessions over, by hash of their sid
+        :param shard_aliases: Connection aliases to spread the shards over,
+            instead of the one of the app's documents
+        :param ttl_index: Whether expired sessions are deleted by a TTL
+            index, or left to :meth:`sweep`
+        :param auto_index: Whether the index of each collection is created
+            on its first use in each process, or only by
+            :meth:`create_indexes`
         """
 
         if not isinstance(collection, basestring):
@@ -39,15 +251,95 @@ class MongoEngineSessionInterface(SessionInterface):
         class DBSession(db.Document):
             sid = db.StringField(primary_key=True)
             data = db.DictField()
+            payload = db.BinaryField()
+            encoding = db.StringField()
+            version = db.IntField()
             expiration = db.DateTimeField()
             meta = {
                 'allow_inheritance': False,
                 'collection': collection,
-                'indexes': [{'fields': ['expiration'],
-                             'expireAfterSeconds': 60 * 60 * 24 * 7 * 31}]
+                'indexes': [self._expiration_index(ttl_index)],
+                'auto_create_index': auto_index,
+                # Sessions aren't routed to the database of each tenant
+                'tenant_shared': True
             }
 
         self.cls = DBSession
+        self.collection = collection
+        self.shards = shards
+        self.shard_aliases = shard_aliases
+        self.ttl_index = ttl_index
+        self.auto_index = auto_index
+        self._indexed = set()
+        self.cache_ttl = cache_ttl
+        self.cache = None
+        if cache_ttl:
+            # Not a QuerySet.cache() backend, so keep it out of invalidations
+            self.cache = MemoryCache(cache_size, register=False)
+
+        self.encoding = None
+        if serializer is not None:
+            self._dumps = _serializer(serializer)[0]
+            self._compress = _compressor(compression)[0]
+            self.encoding = serializer + ('+' + compression if compression else '')
+
+    @staticmethod
+    def _expiration_index(ttl_index):
+        if ttl_index:
+            return {'fields': ['expiration'],
+                    'expireAfterSeconds': TTL_INDEX_DELAY}
+        return {'fields': ['expiration']}
+
+    def _shard_collection(self, index):
+        """
+        Return the collection of a shard, creating its index on first use
+        unless `auto_index` is off.
+        """
+        if self.shards > 1:
+            name = '%s_%d' % (self.collection, index)
+        else:
+            name = self.collection
+        if self.shard_aliases:
+            db = get_db(self.shard_aliases[index % len(self.shard_aliases)])
+        else:
+            db = self.cls._get_db()
+        collection = db[name]
+
+        if self.auto_index and collection.full_name not in self._indexed:
+            self._create_index(collection)
+        return collection
+
+    def _create_index(self, collection):
+        if self.ttl_index:
+            collection.create_index('expiration',
+                                    expireAfterSeconds=TTL_INDEX_DELAY)
+        else:
+            collection.create_index('expiration')
+        self._indexed.add(collection.full_name)
+
+    def _collection(self, sid):
+        """Return the collection a session is stored in."""
+        if self.shards == 1:
+            return self._shard_collection(0)
+
+        digest = hashlib.sha1(sid.encode('utf-8')).hexdigest()
+        return self._shard_collection(int(digest[:8], 16) % self.shards)
+
+    def _collections(self):
+        """Return the collections of all the shards."""
+        return [self._shard_collection(i) for i in range(self.shards)]
+
+    def create_indexes(self):
+        """
+        Create the expiration index of all the session collections and
+        return their names. Needed once when `auto_index` is off, e.g.
+        with the `flask mongoengine create-session-indexes` command.
+        """
+        names = []
+        for collection in self._collections():
+            self._create_index(collection)
+            names.append(collection.full_name)
+        return names
 
     def get_expiration_time(self, app, session):
         if session.permanent:
@@ -56,35 +348,199 @@ class MongoEngineSessionInterface(SessionInterface):
             return datetime.timedelta(**app.config['SESSION_TTL'])
         return datetime.timedelta(days=1)
 
+    def get_refresh_threshold(self, app):
+        """
+        Return the remaining lifetime under which the expiration of an
+        unmodified session is pushed back, or None to never do it.
+        """
+        if 'SESSION_REFRESH_THRESHOLD' in app.config:
+            return datetime.timedelta(**app.config['SESSION_REFRESH_THRESHOLD'])
+        return None
+
     def open_session(self, app, request):
         sid = request.cookies.get(app.session_cookie_name)
         if sid:
-            stored_session = self.cls.objects(sid=sid).first()
+            # The stored session is only loaded once the view uses it
+            return MongoEngineSession(sid=sid, loader=self._open)
 
-            if stored_session:
-                expiration = stored_session.expiration
+        return MongoEngineSession(sid=str(uuid.uuid4()))
 
-                if not expiration.tzinfo:
-                    expiration = expiration.replace(tzinfo=utc)
+    def _open(self, sid):
+        """
+        Return the data and expiration date of a stored session and
+        whether it's stored in another format than the one in use, or
+        None if it doesn't exist or has expired.
+        """
+        stored_session = self._load(sid)
 
-                if expiration > datetime.datetime.utcnow().replace(tzinfo=utc):
-                    return MongoEngineSession(initial=stored_session.data, sid=stored_session.sid)
+        if stored_session:
+            expiration = stored_session['expiration']
 
-        return MongoEngineSession(sid=str(uuid.uuid4()))
+            if not expiration.tzinfo:
+                expiration = expiration.replace(tzinfo=utc)
+
+            if expiration > datetime.datetime.utcnow().replace(tzinfo=utc):
+                if 'payload' in stored_session:
+                    data = _decode_payload(stored_session)
+                    if data is None:
+                        return None
+                    other_format = self.encoding != stored_session['encoding']
+                else:
+                    data = stored_session.get('data')
+                    other_format = self.encoding is not None
+                return data, expiration, other_format
+        return None
+
+    def _load(self, sid):
+        """
+        Return the raw stored session with the given sid, or None. It's
+        read from the cache, if enabled, and straight from the
+        collection otherwise.
+        """
+        if self.cache is not None:
+            data = self.cache.get(sid)
+            if data is not None:
+                return BSON(data).decode()
+
+        stored_session = self._collection(sid).find_one(
+            {'_id': sid}, {'data': True, 'payload': True, 'encoding': True,
+                           'version': True, 'expiration': True})
+        if stored_session is not None and self.cache is not None:
+            self.cache.set(sid, BSON.encode(stored_session), self.cache_ttl)
+        return stored_session
 
     def save_session(self, app, session, response):
         domain = self.get_cookie_domain(app)
         httponly = self.get_cookie_httponly(app)
 
+        # Nothing to do if the view didn't even look at the session
+        if not session.loaded:
+            return
+
         if not session:
             if session.modified:
                 response.delete_cookie(app.session_cookie_name, domain=domain)
             return
 
-        expiration = datetime.datetime.utcnow().replace(tzinfo=utc) + self.get_expiration_time(app, session)
+        now = datetime.datetime.utcnow().replace(tzinfo=utc)
+        expiration = now + self.get_expiration_time(app, session)
+        threshold = self.get_refresh_threshold(app)
 
         if session.modified:
-            self.cls(sid=session.sid, data=session, expiration=expiration).save()
+            self._write(session, expiration)
+        elif threshold is not None:
+            # Sliding expiration: only push the expiration back (and
+            # reissue the cookie) once it's getting close.
+            if session.expiration is None or session.expiration - now >= threshold:
+                return
+            self._update(session.sid, {'$set': {'expiration': expiration}})
 
         response.set_cookie(app.session_cookie_name, session.sid,
                             expires=expiration, httponly=httponly, domain=domain)
+
+    def _write(self, session, expiration):
+        """
+        Write the changed keys of a session, or the whole session if
+        they're unknown or it's stored as a binary payload, along with
+        its new expiration date. This goes
+        straight to the collection, skipping MongoEngine's validation.
+        """
+        if self.encoding is not None:
+            payload = self._compress(self._dumps(dict(session)))
+            update = {'$set': {'payload': Binary(payload),
+                               'encoding': self.encoding,
+                               'version': PAYLOAD_VERSION,
+                               'expiration': expiration},
+                      '$unset': {'data': ''}}
+            self._update(session.sid, update, upsert=True)
+            return
+
+        changes = session._changes()
+        if changes is None:
+            update = {'$set': {'data': dict(session), 'expiration': expiration},
+                      '$unset': {'payload': '', 'encoding': '', 'version': ''}}
+        else:
+            set_fields, unset_fields = changes
+            set_fields['expiration'] = expiration
+            update = {'$set': set_fields}
+            if unset_fields:
+                update['$unset'] = unset_fields
+        self._update(session.sid, update, upsert=True)
+
+    def _update(self, sid, update, upsert=False):
+        """Apply an update to a stored session, acknowledged by the primary only."""
+        if self.cache is not None:
+            self.cache.delete(sid)
+
+        collection = self._collection(sid)
+        # TODO remove the check once PyMongo < 3.0 support is dropped
+        if pymongo.version_tuple[0] >= 3:
+            collection = collection.with_options(write_concern=WriteConcern(w=1))
+            collection.update_one({'_id': sid}, update, upsert=upsert)
+        else:
+            collection.update({'_id': sid}, update, upsert=upsert, w=1)
+
+    def sweep(self, batch_size=1000, max_per_second=None):
+        """
+        Delete the sessions whose expiration date has passed, in batches
+        of `batch_size` sessions and, if `max_per_second` is given, at
+        most at that rate. Return the number of deleted sessions.
+        """
+        deleted = 0
+        for collection in self._collections():
+            while True:
+                started = time.time()
+                now = datetime.datetime.utcnow().replace(tzinfo=utc)
+                expired = {'expiration': {'$lt': now}}
+                sids = [doc['_id'] for doc in
+                        collection.find(expired, {'_id': True}).limit(batch_size)]
+                if not sids:
+                    break
+
+                expired['_id'] = {'$in': sids}
+                # TODO remove the check once PyMongo < 3.0 support is dropped
+                if pymongo.version_tuple[0] >= 3:
+                    deleted += collection.delete_many(expired).deleted_count
+                else:
+                    deleted += collection.remove(expired)['n']
+
+                if max_per_second:
+                    time.sleep(max(0, len(sids) / float(max_per_second) -
+                                   (time.time() - started)))
+                if len(sids) < batch_size:
+                    break
+        return deleted
+
+    def start_sweeper(self, interval=60, batch_size=1000, max_per_second=None):
+        """
+        Start a background thread calling :meth:`sweep` every `interval`
+        seconds and return it. Call its `stop()` method to stop it.
+        """
+        sweeper = _Sweeper(self, interval, batch_size, max_per_second)
+        sweeper.start()
+        return sweeper
+
+
+class _Sweeper(threading.Thread):
+    """Background thread deleting the expired sessions periodically."""
+
+    def __init__(self, interface, interval, batch_size, max_per_second):
+        super(_Sweeper, self).__init__(name='flask_mongoengine session sweeper')
+        self.daemon = True
+        self.interface = interface
+        self.interval = interval
+        self.batch_size = batch_size
+        self.max_per_second = max_per_second
+        self._stopped = threading.Event()
+
+    def run(self):
+        while not self._stopped.is_set():
+            try:
+                self.interface.sweep(self.batch_size, self.max_per_second)
+            except pymongo.errors.PyMongoError:
+                # Try again next time
+                pass
+            self._stopped.wait(self.interval)
+
+    def stop(self):
+        self._stopped.set()
@@ -0,0 +1,128 @@
+import collections
+import functools
+import threading
+
+import mongoengine
+
+from .connection import get_connection
+
+__all__ = ('use_tenant', 'get_tenant', 'get_tenant_db')
+
+
+# Stack of the tenants set by use_tenant in the current thread
+_local = threading.local()
+
+
+class _DatabaseCache(object):
+    """
+    LRU of the database handles of the tenants, so that routing a
+    request to a tenant doesn't need a lookup of its own.
+    """
+
+    def __init__(self, max_size=1000):
+        self.max_size = max_size
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, alias, db_name):
+        """Return the entry of a tenant's database, opening it if needed."""
+        client = get_connection(alias)
+        key = (alias, db_name)
+        with self._lock:
+            entry = self._entries.pop(key, None)
+
+            # The connections are reopened after a fork
+            if entry is None or entry['db'].client is not client:
+                entry = {'db': client[db_name], 'indexed': set()}
+
+            self._entries[key] = entry
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+            return entry
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+_databases = _DatabaseCache()
+
+
+class use_tenant(object):
+    """
+    Context manager and decorator routing the documents inside it to the
+    database of a tenant, on the cluster of the given connection alias.
+    Documents with `'tenant_shared': True` in their meta keep using
+    their own database.
+
+        with db.tenant('acme'):
+            Invoice.objects(paid=False).count()
+    """
+
+    def __init__(self, db_name, alias=mongoengine.DEFAULT_CONNECTION_NAME):
+        self.tenant = (alias, db_name)
+
+    def __enter__(self):
+        if getattr(_local, 'tenants', None) is None:
+            _local.tenants = []
+        _local.tenants.append(self.tenant)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        _local.tenants.pop()
+
+    def __call__(self, f):
+        @functools.wraps(f)
+        def decorated(*args, **kwargs):
+            with self:
+                return f(*args, **kwargs)
+        return decorated
+
+
+def get_tenant(document_cls=None):
+    """
+    Return the (alias, database name) of the tenant set by the innermost
+    use_tenant block in the current thread, or None. If `document_cls`
+    is given, return None for documents shared by all the tenants, too.
+    """
+    stack = getattr(_local, 'tenants', None)
+    if not stack:
+        return None
+    if document_cls is not None and document_cls._meta.get('tenant_shared'):
+        return None
+    return stack[-1]
+
+
+def get_tenant_db(document_cls):
+    """
+    Return the database of the current tenant for a document class, or
+    None if the document isn't routed to a tenant.
+    """
+    tenant = get_tenant(document_cls)
+    if tenant is None:
+        return None
+    return _databases.get(*tenant)['db']
+
+
+def get_tenant_collection(document_cls):
+    """
+    Return the collection of a document class in the database of the
+    current tenant, or None if the document isn't routed to a tenant.
+    The indexes are ensured on first use in each tenant's database.
+    """
+    tenant = get_tenant(document_cls)
+    if tenant is None:
+        return None
+
+    entry = _databases.get(*tenant)
+    name = document_cls._get_collection_name()
+    if document_cls._meta.get('max_size') or document_cls._meta.get('max_documents'):
+        collection = document_cls._get_capped_collection()
+    else:
+        collection = entry['db'][name]
+
+    if name not in entry['indexed']:
+        entry['indexed'].add(name)
+        if document_cls._meta.get('auto_create_index', True):
+            document_cls.ensure_indexes()
+    return collection
@@ -49,6 +49,10 @@ setup(
         'mongoengine>=0.8.0',
         'six',
     ],
+    extras_require={
+        'orjson': ['orjson'],
+        'ujson': ['ujson'],
+    },
     packages=['flask_mongoengine',
               'flask_mongoengine.wtf'],
     include_package_data=True,
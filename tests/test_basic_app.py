@@ -63,6 +63,26 @@ class BasicAppTestCase(FlaskMongoEngineTestCase):
         self.assertEqual(resp.status_code, 200)
         self.assertEquals(resp.data.decode('utf-8'), 'First Item\nThe text')
 
+    def test_projection(self):
+        todo = self.Todo(title='Test', text='test').save()
+
+        with self.app.test_request_context():
+            doc = self.Todo.objects.get_or_404(id=todo.id, only=['title'])
+            self.assertEqual('Test', doc.title)
+            self.assertEqual(None, doc.text)
+
+            doc = self.Todo.objects.first_or_404(exclude='title')
+            self.assertEqual(None, doc.title)
+            self.assertEqual('test', doc.text)
+
+            doc = self.Todo.objects.get_or_404(id=todo.id, only=['title'],
+                                               as_pymongo=True)
+            self.assertEqual({'_id': todo.id, 'title': 'Test'}, doc)
+
+            page = self.Todo.objects.paginate(1, 10, only=['title'],
+                                              as_pymongo=True)
+            self.assertEqual([{'_id': todo.id, 'title': 'Test'}], page.items)
+
     def test_basic_insert(self):
         c = self.app.test_client()
         c.post('/add', data={'title': 'First Item', 'text': 'The text'})
@@ -0,0 +1,136 @@
+from mongoengine import signals
+from nose import SkipTest
+
+from flask_mongoengine import (MemoryCache, MongoEngine, RedisCache,
+                               get_cache_backend)
+from tests import FlaskMongoEngineTestCase
+
+
+class DummyRedis(object):
+    """Bare minimum of a Redis client used by RedisCache."""
+
+    def __init__(self):
+        self.data = {}
+
+    def get(self, key):
+        return self.data.get(key)
+
+    def set(self, key, value, ex=None):
+        self.data[key] = value
+
+    def delete(self, key):
+        self.data.pop(key, None)
+
+
+class CacheTestCase(FlaskMongoEngineTestCase):
+
+    def setUp(self):
+        super(CacheTestCase, self).setUp()
+        db = MongoEngine()
+
+        class Setting(db.Document):
+            name = db.StringField()
+            value = db.StringField()
+
+        db.init_app(self.app)
+        Setting.drop_collection()
+        self.Setting = Setting
+        self.db = db
+
+    def _update_behind_the_cache(self, setting, value):
+        """Change a setting without letting the cache know about it."""
+        self.Setting._get_collection().update_one(
+            {'_id': setting.pk}, {'$set': {'value': value}})
+
+    def test_memory_cache_lru(self):
+        cache = MemoryCache(max_size=2)
+        cache.set('a', b'1')
+        cache.set('b', b'2')
+        self.assertEqual(b'1', cache.get('a'))
+        cache.set('c', b'3')
+        self.assertEqual(None, cache.get('b'))
+        self.assertEqual(b'1', cache.get('a'))
+
+        cache.set('d', b'4', ttl=-1)
+        self.assertEqual(None, cache.get('d'))
+
+    def test_cached_reads(self):
+        setting = self.Setting(name='title', value='Old').save()
+        self._update_behind_the_cache(setting, 'Older')
+
+        cached = self.Setting.objects.cache(ttl=60)
+        self.assertEqual('Older', cached.get(name='title').value)
+        self.assertEqual('Older', cached.first().value)
+        self.assertEqual(['Older'], [s.value for s in cached])
+
+        self._update_behind_the_cache(setting, 'New')
+        self.assertEqual('Older', cached.get(name='title').value)
+        self.assertEqual('Older', cached.first().value)
+        self.assertEqual(['Older'], [s.value for s in cached])
+        self.assertEqual('New', self.Setting.objects.get(name='title').value)
+
+        # Different queries are cached separately
+        self.assertEqual('New', cached.get(pk=setting.pk).value)
+        self.assertEqual(None, cached(name='missing').first())
+
+    def test_invalidation(self):
+        setting = self.Setting(name='title', value='Old').save()
+        cached = self.Setting.objects.cache(ttl=60)
+        self.assertEqual('Old', cached.first().value)
+
+        self.Setting.objects(name='title').update(set__value='New')
+        self.assertEqual('New', cached.first().value)
+
+        if not signals.signals_available:
+            raise SkipTest('Invalidation on save requires blinker')
+
+        setting.reload()
+        setting.value = 'Newer'
+        setting.save()
+        self.assertEqual('Newer', cached.first().value)
+
+        setting.delete()
+        self.assertEqual(None, cached.first())
+
+    def test_writer_without_cache(self):
+        """Make sure writes invalidate a shared cache even when the writer
+        never read the collection through it.
+        """
+        if not signals.signals_available:
+            raise SkipTest('Invalidation on save requires blinker')
+
+        redis = RedisCache(DummyRedis())
+        setting = self.Setting(name='title', value='Old').save()
+        cached = self.Setting.objects.cache(ttl=60, backend=redis)
+        self.assertEqual('Old', cached.get(name='title').value)
+
+        # Another document class of the same collection, as another
+        # process would have, which never used the cache
+        class Writer(self.db.Document):
+            name = self.db.StringField()
+            value = self.db.StringField()
+            meta = {'collection': self.Setting._get_collection_name()}
+
+        writer = Writer.objects.get(pk=setting.pk)
+        writer.value = 'New'
+        writer.save()
+        self.assertEqual('New', cached.get(name='title').value)
+
+        Writer.objects(pk=setting.pk).update(set__value='Newer')
+        self.assertEqual('Newer', cached.get(name='title').value)
+
+    def test_backends(self):
+        setting = self.Setting(name='title', value='Old').save()
+        redis = RedisCache(DummyRedis())
+        cached = self.Setting.objects.cache(ttl=60, backend=redis)
+        self.assertEqual('Old', cached.get(name='title').value)
+        self.assertTrue(redis.client.data)
+
+        self._update_behind_the_cache(setting, 'New')
+        self.assertEqual('Old', cached.get(name='title').value)
+
+        # Without an explicit backend, the app's one is used
+        backend = get_cache_backend()
+        self.assertTrue(isinstance(backend, MemoryCache))
+        self.assertTrue(
+            backend is self.app.extensions['mongoengine'][self.db]['cache'])
@@ -1,3 +1,7 @@
+import os
+import time
+
+import flask
 import mongoengine
 from mongoengine.context_managers import switch_db
 from nose import SkipTest
@@ -6,7 +10,10 @@ import pymongo
 from pymongo.errors import InvalidURI
 from pymongo.read_preferences import ReadPreference
 
-from flask_mongoengine import MongoEngine
+from flask_mongoengine import (MongoEngine, get_connection_settings,
+                               get_health_monitor, get_read_alias,
+                               reset_connections, stop_health_monitor)
+from flask_mongoengine import connection
 
 from tests import FlaskMongoEngineTestCase
 
@@ -193,3 +200,205 @@ class ConnectionTestCase(FlaskMongoEngineTestCase):
             db.connection.read_preference,
             ReadPreference.SECONDARY
         )
+
+    def test_lazy_connection(self):
+        """Make sure connections are only opened on first use."""
+        self.app.config['MONGODB_SETTINGS'] = {
+            'ALIAS': 'lazy_conn',
+            'DB': 'flask_mongoengine_test_db',
+        }
+        db = MongoEngine()
+        db.init_app(self.app)
+        self.assertFalse('lazy_conn' in mongoengine.connection._connections)
+
+        connection = db.connection
+        self.assertTrue('lazy_conn' in mongoengine.connection._connections)
+        self.assertTrue(connection is db.connection)
+
+        # Connections are reopened after a reset, e.g. in a forked process
+        reset_connections()
+        self.assertFalse('lazy_conn' in mongoengine.connection._connections)
+        self.assertFalse(connection is db.connection)
+        self._do_persist(MongoEngine(), alias='lazy_conn')
+
+    def test_fork_check(self):
+        """Make sure documents reopen the connections in a forked process."""
+        db = MongoEngine()
+        db.init_app(self.app)
+
+        class Todo(db.Document):
+            title = db.StringField()
+
+        Todo.objects.count()
+        client = mongoengine.connection._connections['default']
+
+        # Pretend the process was forked since the connection was opened
+        connection._pid = -1
+        Todo.objects.count()
+        self.assertEqual(os.getpid(), connection._pid)
+        self.assertFalse(client is mongoengine.connection._connections['default'])
+
+    def test_pool_settings(self):
+        """Make sure the pool settings are passed on to PyMongo."""
+        self.app.config['MONGODB_MAX_POOL_SIZE'] = 50
+        self.app.config['MONGODB_MIN_POOL_SIZE'] = 5
+        self.app.config['MONGODB_WAIT_QUEUE_TIMEOUT_MS'] = 100
+        settings = get_connection_settings(self.app.config)
+
+        if pymongo.version_tuple[0] >= 3:
+            self.assertEqual(50, settings['maxpoolsize'])
+            self.assertEqual(5, settings['minpoolsize'])
+            self.assertEqual(100, settings['waitqueuetimeoutms'])
+        else:
+            self.assertEqual(50, settings['max_pool_size'])
+
+    def test_memoized_settings(self):
+        """Make sure settings are only parsed once per config and apps
+        with the same settings share their client.
+        """
+        self.app.config['MONGODB_SETTINGS'] = {
+            'ALIAS': 'shared',
+            'DB': 'flask_mongoengine_test_db',
+            'READ_PREFERENCE': ReadPreference.SECONDARY_PREFERRED,
+        }
+        settings = get_connection_settings(self.app.config)
+        self.assertTrue(settings is get_connection_settings(
+            dict(self.app.config)))
+        self.assertEqual('shared', settings['alias'])
+        with assert_raises(TypeError):
+            settings['alias'] = 'other'
+
+        db = MongoEngine()
+        db.init_app(self.app)
+        connection = db.connection
+
+        other_app = flask.Flask(__name__)
+        other_app.config.update(self.app.config)
+        other_db = MongoEngine(other_app)
+        with other_app.app_context():
+            self.assertTrue(connection is other_db.connection)
+
+        # Another database on the same cluster shares the client, too
+        other_app = flask.Flask(__name__)
+        other_app.config['MONGODB_SETTINGS'] = dict(
+            self.app.config['MONGODB_SETTINGS'],
+            ALIAS='other_db', DB='flask_mongoengine_test_db_2')
+        other_db = MongoEngine(other_app)
+        with other_app.app_context():
+            self.assertTrue(connection is other_db.connection)
+
+    def test_read_from(self):
+        """Make sure reads can be routed to other members of a replica
+        set, both explicitly and by endpoint.
+        """
+        if pymongo.version_tuple[0] < 3:
+            raise SkipTest('Read preference modes require PyMongo >= 3.0')
+
+        self.app.config['MONGODB_READ_PREFERENCE_RULES'] = {
+            'report': {'mode': 'secondaryPreferred', 'max_staleness': 120},
+        }
+        db = MongoEngine()
+
+        class Todo(db.Document):
+            title = db.StringField(max_length=60)
+
+        db.init_app(self.app)
+
+        def read_preference():
+            return Todo.objects._cursor.collection.read_preference
+
+        @self.app.route('/report')
+        def report():
+            return read_preference().mongos_mode
+
+        @self.app.route('/list')
+        def list_todos():
+            return read_preference().mongos_mode
+
+        @self.app.route('/nearest')
+        @db.read_from('nearest')
+        def nearest():
+            return read_preference().mongos_mode
+
+        self.assertEqual(ReadPreference.PRIMARY, read_preference())
+        with db.read_from('secondary'):
+            self.assertEqual(ReadPreference.SECONDARY, read_preference())
+            with db.read_from('primaryPreferred'):
+                self.assertEqual(ReadPreference.PRIMARY_PREFERRED,
+                                 read_preference())
+            # QuerySet's own read preference takes precedence
+            self.assertEqual(
+                ReadPreference.NEAREST,
+                Todo.objects.read_preference(ReadPreference.NEAREST)
+                ._cursor.collection.read_preference)
+        self.assertEqual(ReadPreference.PRIMARY, read_preference())
+
+        c = self.app.test_client()
+        self.assertEqual(b'secondaryPreferred', c.get('/report').data)
+        self.assertEqual(b'primary', c.get('/list').data)
+        self.assertEqual(b'nearest', c.get('/nearest').data)
+        self.assertEqual(b'primary', c.get('/list').data)
+
+    def test_read_failover(self):
+        """Make sure reads fail over to the fallback alias while the
+        health monitor marks the main one degraded.
+        """
+        self.app.config['MONGODB_SETTINGS'] = [
+            {
+                'ALIAS': 'default',
+                'DB': 'flask_mongoengine_test_db_1',
+                'HOST': 'localhost',
+                'PORT': 27017,
+                'FALLBACK': 'backup',
+            },
+            {
+                'ALIAS': 'backup',
+                'DB': 'flask_mongoengine_test_db_2',
+                'HOST': 'localhost',
+                'PORT': 27017,
+            },
+        ]
+        self.app.config['MONGODB_HEALTH_CHECK_INTERVAL'] = 3600
+        db = MongoEngine()
+
+        class Todo(db.Document):
+            title = db.StringField(max_length=60)
+
+        db.init_app(self.app)
+
+        # The monitor is only started (and connects) on first use
+        self.assertFalse('default' in connection._monitors)
+        self.assertFalse('default' in mongoengine.connection._connections)
+        monitor = get_health_monitor('default')
+        try:
+            Todo.drop_collection()
+            Todo(title='Testing').save()
+
+            monitor.check()
+            self.assertFalse(monitor.degraded)
+            self.assertTrue(monitor.selection_latency is not None)
+            self.assertTrue(monitor.rtt is not None)
+            self.assertEqual('default', get_read_alias('default'))
+            self.assertEqual(1, Todo.objects.count())
+
+            # A ping stuck for longer than the timeout degrades the alias
+            monitor._ping_started = time.time() - monitor.timeout - 1
+            self.assertTrue(monitor.degraded)
+            self.assertEqual('backup', get_read_alias('default'))
+            self.assertEqual(0, Todo.objects.count())
+            self.assertEqual(None, Todo.objects.first())
+
+            # Writes still go to the main alias
+            Todo(title='Testing').save()
+            monitor._ping_started = None
+            self.assertEqual(2, Todo.objects.count())
+
+            # Forked processes start a monitor of their own
+            monitor.pid = -1
+            self.assertEqual(2, Todo.objects.count())
+            self.assertFalse(monitor is connection._monitors['default'])
+            monitor.stop()
+            monitor = get_health_monitor('default')
+            self.assertEqual(os.getpid(), monitor.pid)
+        finally:
+            stop_health_monitor('default')
@@ -0,0 +1,77 @@
+import flask
+
+from flask_mongoengine import MongoEngine
+from tests import FlaskMongoEngineTestCase
+
+
+class IdentityMapTestCase(FlaskMongoEngineTestCase):
+
+    def setUp(self):
+        super(IdentityMapTestCase, self).setUp()
+        self.app.config['MONGODB_IDENTITY_MAP'] = True
+        db = MongoEngine()
+
+        class Todo(db.Document):
+            title = db.StringField(max_length=60)
+
+        db.init_app(self.app)
+        Todo.drop_collection()
+        self.Todo = Todo
+        self.db = db
+
+    def test_get_returns_loaded_instance(self):
+        todo = self.Todo(title='Test').save()
+
+        with self.app.app_context():
+            first = self.Todo.objects.get(pk=todo.pk)
+            self.assertTrue(first is self.Todo.objects.get(id=str(todo.pk)))
+            self.assertTrue(first is self.Todo.objects.get_or_404(id=todo.pk))
+            self.assertEqual({'hits': 2, 'misses': 1, 'size': 1},
+                             self.db.identity_map.stats)
+
+            # Filtered or projected lookups always go to the database
+            self.assertFalse(
+                first is self.Todo.objects(title='Test').get(pk=todo.pk))
+            self.assertFalse(
+                first is self.Todo.objects.only('title').get(pk=todo.pk))
+
+        # The identity map is dropped along with the app context
+        with self.app.app_context():
+            self.assertEqual(0, len(self.db.identity_map))
+            self.assertFalse(first is self.Todo.objects.get(pk=todo.pk))
+
+    def test_in_bulk_only_fetches_missing(self):
+        todos = [self.Todo(title='Test %s' % i).save() for i in range(3)]
+
+        with self.app.test_request_context():
+            first = self.Todo.objects.get(pk=todos[0].pk)
+            docs = self.Todo.objects.in_bulk([t.pk for t in todos])
+            self.assertEqual(3, len(docs))
+            self.assertTrue(first is docs[todos[0].pk])
+            self.assertTrue(docs[todos[1].pk] is
+                            self.Todo.objects.get(pk=todos[1].pk))
+
+    def test_writes_discard_documents(self):
+        todo = self.Todo(title='Test').save()
+
+        with self.app.test_request_context():
+            self.Todo.objects.get(pk=todo.pk).delete()
+            self.assertEqual(0, len(self.db.identity_map))
+            self.assertRaises(self.Todo.DoesNotExist, self.Todo.objects.get,
+                              pk=todo.pk)
+
+            self.Todo.objects.get(pk=self.Todo(title='Test').save().pk)
+            self.Todo.objects(title='Test').update(set__title='Updated')
+            self.assertEqual(0, len(self.db.identity_map))
+
+            # Saving another instance of a mapped document
+            pk = self.Todo.objects.get(title='Updated').pk
+            mapped = self.Todo.objects.get(pk=pk)
+            self.Todo(pk=mapped.pk, title='New').save()
+            self.assertEqual('New', self.Todo.objects.get(pk=mapped.pk).title)
+            self.assertEqual('New', self.Todo.objects.in_bulk([mapped.pk])[mapped.pk].title)
+
+    def test_disabled_by_default(self):
+        app = flask.Flask(__name__)
+        with app.app_context():
+            self.assertEqual(None, self.db.identity_map)
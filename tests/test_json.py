@@ -1,6 +1,11 @@
+import datetime
+import decimal
+
+from bson import ObjectId, json_util
 import flask
 
 from flask_mongoengine import MongoEngine
+from flask_mongoengine.json import _json_mode, override_json_encoder
 from tests import FlaskMongoEngineTestCase
 
 
@@ -39,3 +44,140 @@ class JSONAppTestCase(FlaskMongoEngineTestCase):
         # Since the class is dynamically derrived, must compare class names
         # rather than class objects.
         self.assertEqual(json_encoder_name, 'MongoEngineJSONEncoder')
+
+    def test_document_serializer(self):
+        """Make sure documents are encoded the same as through to_mongo."""
+        db = self.db
+
+        class Comment(db.EmbeddedDocument):
+            text = db.StringField()
+            posted = db.DateTimeField()
+            meta = {'allow_inheritance': True}
+
+        class Author(db.Document):
+            name = db.StringField()
+
+        class Post(db.Document):
+            title = db.StringField()
+            rank = db.IntField()
+            score = db.FloatField()
+            price = db.DecimalField(precision=2)
+            published = db.BooleanField()
+            created = db.DateTimeField()
+            author = db.ReferenceField(Author)
+            comments = db.ListField(db.EmbeddedDocumentField(Comment))
+            top_comment = db.EmbeddedDocumentField(Comment)
+            tags = db.ListField(db.StringField())
+            subtitle = db.StringField(null=True)
+            extra = db.DictField()
+
+        now = datetime.datetime(2020, 1, 2, 3, 4, 5)
+        author = Author(id=ObjectId(), name='Jane')
+        post = Post(id=ObjectId(), title=u'T\xeftle', rank=3, score=1,
+                    price=decimal.Decimal('9.99'), published=True,
+                    created=now, author=author,
+                    comments=[Comment(text='Hi', posted=now)],
+                    top_comment=Comment(text='Top'), tags=['a', 'b'],
+                    extra={'when': now, 'id': author.id})
+
+        encoder = self.app.json_encoder()
+        expected = json_util._json_convert(post.to_mongo())
+        self.assertEqual(expected, encoder.default(post))
+        self.assertEqual(json_util._json_convert(author.to_mongo()),
+                         encoder.default(author))
+        self.assertTrue((None, _json_mode()) in Post.__dict__['_json_serializers'])
+
+        # Fields overriding to_mongo don't take the shortcuts
+        class UpperField(db.StringField):
+            def to_mongo(self, value):
+                return value.upper()
+
+        class Tag(db.Document):
+            name = UpperField()
+
+        tag = Tag(id=ObjectId(), name='abc')
+        self.assertEqual(json_util._json_convert(tag.to_mongo()),
+                         encoder.default(tag))
+        self.assertEqual('ABC', encoder.default(tag)['name'])
+
+        # Nor do fields overriding to_python, which to_mongo relies on
+        class RoundedField(db.IntField):
+            def to_python(self, value):
+                return value - value % 10
+
+        class Score(db.Document):
+            value = RoundedField()
+
+        score = Score(id=ObjectId())
+        score.value = 42
+        self.assertEqual(json_util._json_convert(score.to_mongo()),
+                         encoder.default(score))
+        self.assertEqual(40, encoder.default(score)['value'])
+
+        # Faster JSON libraries encode to the same JSON
+        for backend in ('orjson', 'ujson'):
+            try:
+                __import__(backend)
+            except ImportError:
+                continue
+            self.app.json_encoder = DummyEncoder
+            self.app.config['MONGODB_JSON_BACKEND'] = backend
+            self.app.config['JSON_SORT_KEYS'] = False
+            override_json_encoder(self.app)
+            with self.app.test_request_context():
+                self.assertEqual(expected,
+                                 flask.json.loads(flask.json.dumps(post)))
+                self.assertEqual([expected], flask.json.loads(
+                    flask.jsonify([post, None]).data)[:1])
+
+    def test_json_modes(self):
+        db = self.db
+
+        class Event(db.Document):
+            name = db.StringField()
+            count = db.IntField()
+            score = db.FloatField()
+            price = db.DecimalField()
+            date = db.DateTimeField()
+            extra = db.DictField()
+
+        Event.drop_collection()
+        date = datetime.datetime(2020, 1, 2, 3, 4, 5, 678000)
+        event = Event(name='Launch', count=3, score=float('inf'),
+                      price=decimal.Decimal('1.5'), date=date,
+                      extra={'date': date}).save()
+        son = event.to_mongo()
+
+        for name in ('legacy', 'relaxed', 'canonical'):
+            self.app.config['MONGODB_JSON_MODE'] = name
+            override_json_encoder(self.app)
+            options = getattr(json_util, name.upper() + '_JSON_OPTIONS')
+            encoder = self.app.json_encoder()
+            expected = json_util._json_convert(son, options)
+            self.assertEqual(expected, encoder.default(event))
+            self.assertEqual(encoder.json_mode.convert(son),
+                             encoder.default(event))
+            self.assertEqual([dict(expected)],
+                             [dict(d) for d in encoder.default(Event.objects)])
+
+        self.app.config['MONGODB_JSON_MODE'] = 'plain'
+        override_json_encoder(self.app)
+        encoder = self.app.json_encoder()
+        data = encoder.default(event)
+        self.assertEqual(str(event.pk), data['_id'])
+        self.assertEqual('2020-01-02T03:04:05.678Z', data['date'])
+        self.assertEqual('2020-01-02T03:04:05.678Z', data['extra']['date'])
+        self.assertEqual({'$numberDouble': 'Infinity'}, data['score'])
+        self.assertEqual(1.5, data['price'])
+        self.assertEqual(encoder.json_mode.convert(son), data)
+        self.assertEqual(
+            [data], flask.json.loads(''.join(encoder.iterencode(Event.objects))))
+
+        self.app.config['MONGODB_JSON_DATE_FORMAT'] = 'millis'
+        override_json_encoder(self.app)
+        data = self.app.json_encoder().default(event)
+        self.assertEqual(1577934245678, data['date'])
+        self.assertEqual(1577934245678, data['extra']['date'])
+
+        self.app.config['MONGODB_JSON_MODE'] = 'compact'
+        self.assertRaises(ValueError, override_json_encoder, self.app)
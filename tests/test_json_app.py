@@ -1,7 +1,7 @@
 import datetime
 import flask
 
-from flask_mongoengine import MongoEngine
+from flask_mongoengine import MongoEngine, jsonify, jsonify_stream
 from tests import FlaskMongoEngineTestCase
 
 
@@ -28,6 +28,8 @@ class JSONAppTestCase(FlaskMongoEngineTestCase):
             text = db.StringField()
             done = db.BooleanField(default=False)
             pub_date = db.DateTimeField(default=datetime.datetime.now)
+            meta = {'json_views': {'summary': ['id', 'title'],
+                                   'broken': ['title', 'missing']}}
 
         db.init_app(self.app)
 
@@ -46,6 +48,22 @@ class JSONAppTestCase(FlaskMongoEngineTestCase):
             todo.save()
             return flask.jsonify(result=todo)
 
+        @self.app.route('/export')
+        def export():
+            return jsonify_stream(self.Todo.objects.order_by('title'),
+                                  batch_size=2)
+
+        @self.app.route('/summary')
+        def summary():
+            return jsonify(result=self.Todo.objects.order_by('title'),
+                           first=self.Todo.objects.order_by('title').first(),
+                           view='summary')
+
+        @self.app.route('/summary/export')
+        def export_summary():
+            return jsonify_stream(self.Todo.objects.order_by('title'),
+                                  batch_size=2, view='summary')
+
         @self.app.route('/show/<id>/')
         def show(id):
             return flask.jsonify(result=self.Todo.objects.get_or_404(id=id))
@@ -86,3 +104,43 @@ class JSONAppTestCase(FlaskMongoEngineTestCase):
                 self.dictContains(obj, d1),
                 self.dictContains(obj, d2)
             ]))
+
+    def test_stream(self):
+        c = self.app.test_client()
+        self.assertEqual([], flask.json.loads(c.get('/export').data))
+
+        for i in range(5):
+            c.post('/add', data={'title': 'Item %s' % i, 'text': 'The text'})
+        resp = c.get('/export')
+        self.assertTrue(resp.is_streamed)
+        result = flask.json.loads(resp.data)
+        self.assertEqual(['Item %s' % i for i in range(5)],
+                         [obj['title'] for obj in result])
+
+    def test_view(self):
+        c = self.app.test_client()
+        for i in range(3):
+            c.post('/add', data={'title': 'Item %s' % i, 'text': 'The text'})
+        ids = [{'$oid': str(todo.pk)}
+               for todo in self.Todo.objects.order_by('title')]
+
+        data = flask.json.loads(c.get('/summary').data)
+        self.assertEqual({'_id': ids[0], 'title': 'Item 0'}, data['first'])
+        self.assertEqual([{'_id': id, 'title': 'Item %s' % i}
+                          for i, id in enumerate(ids)], data['result'])
+
+        data = flask.json.loads(c.get('/summary/export').data)
+        self.assertEqual([{'_id': id, 'title': 'Item %s' % i}
+                          for i, id in enumerate(ids)], data)
+
+        with self.app.app_context():
+            self.assertRaises(ValueError, jsonify, self.Todo.objects, view='x')
+
+            # Unknown fields are reported as such on every path
+            for obj in (self.Todo.objects, self.Todo.objects.first()):
+                try:
+                    jsonify(obj, view='broken')
+                except ValueError as e:
+                    self.assertTrue("'broken'" in str(e) and 'missing' in str(e))
+                else:
+                    self.fail('ValueError not raised')
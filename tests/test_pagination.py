@@ -1,7 +1,10 @@
 import unittest
+from bson import ObjectId
+import flask
 from werkzeug.exceptions import NotFound
 
-from flask_mongoengine import ListFieldPagination, MongoEngine, Pagination
+from flask_mongoengine import (KeysetPagination, ListFieldPagination,
+                               MongoEngine, Pagination)
 from tests import FlaskMongoEngineTestCase
 
 
@@ -38,6 +41,178 @@ class PaginationTestCase(FlaskMongoEngineTestCase):
         paginator = Pagination(Post.objects, 1, 10)
         self._test_paginator(paginator)
 
+    def test_queryset_paginator_count_modes(self):
+        with self.app.test_request_context('/'):
+            db = self.db
+
+            class Post(db.Document):
+                title = db.StringField(required=True, max_length=200)
+
+            for i in range(42):
+                Post(title="post: %s" % i).save()
+
+        self.assertRaises(ValueError, Pagination, Post.objects, 1, 10,
+                          count='bogus')
+
+        for count in ('exact', 'estimated', 'cached'):
+            paginator = Post.objects.paginate(page=1, per_page=10,
+                                              count=count)
+            self.assertEqual(42, paginator.total)
+            self._test_paginator(paginator)
+
+        # Cached totals are reused until they expire
+        Post(title="post: 42").save()
+        paginator = Post.objects.paginate(page=1, per_page=10, count='cached')
+        self.assertEqual(42, paginator.total)
+        paginator = Post.objects.paginate(page=1, per_page=10, count='cached',
+                                          count_ttl=0)
+        self.assertEqual(43, paginator.total)
+        Post.objects(title="post: 42").delete()
+
+        # Each app remembers its own totals
+        paginator = Post.objects.paginate(page=1, per_page=10, count='cached',
+                                          count_ttl=0)
+        self.assertEqual(42, paginator.total)
+        Post(title="post: 42").save()
+        with flask.Flask(__name__).app_context() as ctx:
+            MongoEngine(ctx.app)
+            paginator = Post.objects.paginate(page=1, per_page=10,
+                                              count='cached')
+            self.assertEqual(43, paginator.total)
+        Post.objects(title="post: 42").delete()
+
+        # Estimates are only used for unfiltered querysets
+        paginator = Post.objects(title="post: 1").paginate(
+            page=1, per_page=10, count='estimated')
+        self.assertEqual(1, paginator.total)
+
+        # Without a count, pages are discovered one at a time
+        paginator = Post.objects.paginate(page=1, per_page=10, count='none')
+        self.assertEqual(None, paginator.total)
+        self.assertEqual(10, len(paginator.items))
+        for i in [1, 2, 3, 4]:
+            self.assertTrue(paginator.has_next)
+            self.assertEqual(i + 1, paginator.pages)
+            paginator = paginator.next()
+        self.assertEqual(2, len(paginator.items))
+        self.assertFalse(paginator.has_next)
+        self.assertEqual(5, paginator.pages)
+        self.assertRaises(NotFound, Post.objects.paginate, 6, 10, count='none')
+
+    def test_queryset_paginator_navigation(self):
+        with self.app.test_request_context('/'):
+            db = self.db
+
+            class Post(db.Document):
+                title = db.StringField(required=True, max_length=200)
+
+            for i in range(42):
+                Post(title="post: %s" % i).save()
+
+        queryset = Post.objects.order_by('title').skip(0)
+        paginator = Pagination(queryset, 2, 10)
+
+        # Neighbouring pages are only fetched once
+        self.assertTrue(paginator.next() is paginator.next())
+        self.assertTrue(paginator.prev() is paginator.prev())
+        self.assertTrue(paginator.next().prev() is paginator)
+        self.assertTrue(paginator.prev().next() is paginator)
+
+        # The original queryset is left alone
+        self.assertEqual(0, queryset._skip)
+
+        # The total is only counted for the first page
+        Post(title="post: 99").save()
+        self.assertEqual(42, paginator.next().next().total)
+        self.assertEqual(list(Post.objects.order_by('title')[30:40]),
+                         paginator.next().next().items)
+
+    def test_lazy_queryset_paginator(self):
+        with self.app.test_request_context('/'):
+            db = self.db
+
+            class Author(db.Document):
+                name = db.StringField()
+
+            class Post(db.Document):
+                title = db.StringField(required=True, max_length=200)
+                author = db.ReferenceField(Author)
+
+            author = Author(name="author").save()
+            for i in range(42):
+                Post(title="post: %s" % i, author=author).save()
+
+        self.assertRaises(ValueError, Pagination, Post.objects, 1, 10,
+                          count='none', lazy=True)
+        self.assertRaises(NotFound, Pagination, Post.objects, 6, 10,
+                          lazy=True)
+
+        paginator = Post.objects.paginate(page=5, per_page=10, lazy=True,
+                                          batch_size=3)
+        self.assertFalse(isinstance(paginator.items, list))
+        items = list(paginator.items)
+        self.assertEqual(list(Post.objects[40:42]), items)
+        self.assertEqual("author", items[0].author.name)
+
+        paginator = paginator.prev()
+        self.assertEqual(list(Post.objects[30:40]), list(paginator.items))
+        self._test_paginator(Pagination(Post.objects, 1, 10, lazy=True))
+
+    def test_queryset_paginator_select_related(self):
+        with self.app.test_request_context('/'):
+            db = self.db
+
+            class Company(db.Document):
+                name = db.StringField()
+
+            class Author(db.Document):
+                name = db.StringField()
+                company = db.ReferenceField(Company)
+
+            class Comment(db.EmbeddedDocument):
+                author = db.ReferenceField(Author)
+
+            class Post(db.Document):
+                title = db.StringField(required=True, max_length=200)
+                author = db.ReferenceField(Author)
+                editor = db.ReferenceField(Author)
+                tags = db.ListField(db.ReferenceField(Company))
+                comments = db.ListField(db.EmbeddedDocumentField(Comment))
+
+            company = Company(name="company").save()
+            author = Author(name="author", company=company).save()
+            for i in range(42):
+                Post(title="post: %s" % i, author=author, editor=author,
+                     tags=[company], comments=[Comment(author=author)]).save()
+
+        paginator = Post.objects.paginate(
+            page=1, per_page=10,
+            select_related=['author.company', 'tags', 'comments.author'],
+            max_depth=2)
+        self._test_paginator(paginator)
+
+        post = paginator.items[0]
+        self.assertTrue(isinstance(post._data['author'], Author))
+        self.assertTrue(isinstance(post._data['author']._data['company'],
+                                   Company))
+        self.assertTrue(isinstance(post._data['tags'][0], Company))
+        self.assertTrue(isinstance(post.comments[0]._data['author'], Author))
+        self.assertFalse(isinstance(post._data['editor'], Author))
+        self.assertEqual([], post._get_changed_fields())
+
+        # References beyond max_depth are left alone
+        paginator = Post.objects.paginate(
+            page=1, per_page=10, select_related=['author.company'])
+        author = paginator.items[0]._data['author']
+        self.assertTrue(isinstance(author, Author))
+        self.assertFalse(isinstance(author._data['company'], Company))
+
+        paginator = Post.objects.paginate(page=1, per_page=10,
+                                          select_related=False, lazy=True)
+        post = next(paginator.items)
+        self.assertFalse(isinstance(post._data['author'], Author))
+        self.assertEqual("author", post.author.name)
+
     def test_paginate_plain_list(self):
 
         self.assertRaises(NotFound, Pagination, range(1, 42), 0, 10)
@@ -73,6 +248,95 @@ class PaginationTestCase(FlaskMongoEngineTestCase):
             paginator = post.paginate_field('comments', 1, 10)
             self._test_paginator(paginator)
 
+            paginator = Post.objects.paginate_field('comments', post.id, 1, 10)
+            self.assertEqual(comments[:10], paginator.items)
+            self._test_paginator(paginator)
+
+            self.assertRaises(NotFound, ListFieldPagination, Post.objects,
+                              ObjectId(), "comments", 1, 10)
+
+    def test_keyset_pagination(self):
+        with self.app.test_request_context('/'):
+            db = self.db
+
+            class Post(db.Document):
+                title = db.StringField(required=True, max_length=200)
+                rank = db.IntField()
+
+            for i in range(42):
+                Post(title="post: %s" % i, rank=i % 4).save()
+
+            self.assertRaises(NotFound, KeysetPagination, Post.objects, 10,
+                              'not-a-cursor')
+
+            expected = list(Post.objects.order_by('-rank', '-id'))
+            paginator = Post.objects.paginate_after(None, 10, sort='-rank')
+            self.assertFalse(paginator.has_prev)
+            self.assertEqual(None, paginator.prev_cursor)
+
+            seen = []
+            pages = [paginator]
+            while True:
+                seen.extend(paginator.items)
+                if not paginator.has_next:
+                    break
+                paginator = paginator.next()
+                pages.append(paginator)
+                self.assertTrue(paginator.has_prev)
+
+            self.assertEqual(5, len(pages))
+            self.assertEqual(expected, seen)
+            self.assertEqual(None, paginator.next_cursor)
+            self.assertRaises(NotFound, paginator.next)
+
+            # Walk back to the first page
+            for page in reversed(pages[:-1]):
+                paginator = paginator.prev()
+                self.assertEqual(page.items, paginator.items)
+            self.assertFalse(paginator.has_prev)
+
+            # Cursors are bound to the sort order they were issued for
+            cursor = pages[1].next_cursor
+            self.assertRaises(NotFound, Post.objects.paginate_after, cursor,
+                              10, sort='title')
+
+    def test_keyset_pagination_nulls(self):
+        with self.app.test_request_context('/'):
+            db = self.db
+
+            class Post(db.Document):
+                title = db.StringField(required=True, max_length=200)
+                rank = db.IntField()
+
+            Post.drop_collection()
+            for i in range(12):
+                Post(title="post: %s" % i,
+                     rank=None if i % 3 == 0 else i % 4).save()
+
+            for sort in ('rank', '-rank'):
+                expected = list(Post.objects.order_by(sort, sort[:-4] + 'id'))
+                paginator = Post.objects.paginate_after(None, 2, sort=sort)
+                pages = [paginator]
+                seen = list(paginator.items)
+                while paginator.has_next:
+                    paginator = paginator.next()
+                    pages.append(paginator)
+                    seen.extend(paginator.items)
+                self.assertEqual(expected, seen)
+
+                for page in reversed(pages[:-1]):
+                    paginator = paginator.prev()
+                    self.assertEqual(page.items, paginator.items)
+
+            # The sort keys have to be loaded to build the cursors
+            self.assertRaises(ValueError, Post.objects.only('title').paginate_after,
+                              None, 2, sort='rank')
+            self.assertRaises(ValueError, Post.objects.exclude('rank').paginate_after,
+                              None, 2, sort='rank')
+            paginator = Post.objects.only('rank').paginate_after(None, 2,
+                                                                 sort='rank')
+            self.assertEqual(2, len(paginator.items))
+
     def _test_paginator(self, paginator):
             self.assertEqual(5, paginator.pages)
             self.assertEqual([1, 2, 3, 4, 5], list(paginator.iter_pages()))
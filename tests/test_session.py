@@ -1,7 +1,9 @@
+import datetime
 import unittest
 
 from flask import session
-from flask_mongoengine import MongoEngine, MongoEngineSessionInterface
+from nose import SkipTest
+from flask_mongoengine import MongoEngine, MongoEngineSessionInterface, cache
 from tests import FlaskMongoEngineTestCase
 
 
@@ -51,6 +53,189 @@ class SessionTestCase(FlaskMongoEngineTestCase):
         self.assertEqual(resp.status_code, 200)
         self.assertEquals(resp.data.decode('utf-8'), 'sessions: 1')
 
+    def test_writes_changed_keys_only(self):
+        collection = self.app.session_interface.cls._get_collection()
+
+        @self.app.route('/set/<key>/<value>')
+        def set_value(key, value):
+            session[key] = value
+            if key == 'c':
+                # Written by another request in the meantime
+                collection.update_one({'_id': session.sid},
+                                      {'$set': {'data.b': '2'}})
+            return 'ok'
+
+        @self.app.route('/del/<key>')
+        def del_value(key):
+            del session[key]
+            return 'ok'
+
+        c = self.app.test_client()
+        c.get('/set/a/1')
+        c.get('/set/c/3')
+        self.assertEqual({'a': '1', 'b': '2', 'c': '3'},
+                         collection.find_one()['data'])
+
+        c.get('/del/a')
+        self.assertEqual({'b': '2', 'c': '3'}, collection.find_one()['data'])
+
+    def test_sliding_expiration(self):
+        self.app.config['SESSION_REFRESH_THRESHOLD'] = {'hours': 1}
+        collection = self.app.session_interface.cls._get_collection()
+        c = self.app.test_client()
+
+        resp = c.get('/')
+        self.assertTrue('Set-Cookie' in resp.headers)
+        expiration = collection.find_one()['expiration']
+
+        # Far from expiring, so neither written nor reissued
+        resp = c.get('/check-session')
+        self.assertFalse('Set-Cookie' in resp.headers)
+        self.assertEqual(expiration, collection.find_one()['expiration'])
+
+        soon = datetime.datetime.utcnow() + datetime.timedelta(minutes=30)
+        collection.update_one({}, {'$set': {'expiration': soon}})
+        resp = c.get('/check-session')
+        self.assertTrue('Set-Cookie' in resp.headers)
+        self.assertTrue(collection.find_one()['expiration'] >
+                        soon + datetime.timedelta(hours=12))
+
+    def test_cache(self):
+        self.app.session_interface = MongoEngineSessionInterface(
+            self.db, cache_ttl=60)
+        collection = self.app.session_interface.cls._get_collection()
+
+        @self.app.route('/check-b')
+        def check_b():
+            return "b: %s" % session.get('b')
+
+        c = self.app.test_client()
+        c.get('/')
+        c.get('/check-b')
+
+        # Reads are served by the cache...
+        collection.update_one({}, {'$set': {'data.b': 'set elsewhere'}})
+        resp = c.get('/check-b')
+        self.assertEqual('b: None', resp.data.decode('utf-8'))
+
+        # ...until the session is saved by this process
+        c.get('/')
+        resp = c.get('/check-b')
+        self.assertEqual('b: set elsewhere', resp.data.decode('utf-8'))
+
+        # Query cache invalidations don't touch the session cache
+        self.assertFalse(self.app.session_interface.cache in cache._backends)
+
+    def test_lazy_loading(self):
+        interface = self.app.session_interface
+        loaded = []
+        load = interface._load
+
+        def spy(sid):
+            loaded.append(sid)
+            return load(sid)
+        interface._load = spy
+
+        @self.app.route('/ignore-session')
+        def ignore_session():
+            return 'ok'
+
+        c = self.app.test_client()
+        c.get('/')
+        resp = c.get('/ignore-session')
+        self.assertEqual([], loaded)
+        self.assertFalse('Set-Cookie' in resp.headers)
+
+        resp = c.get('/check-session')
+        self.assertEqual('session: hello session', resp.data.decode('utf-8'))
+        self.assertEqual(1, len(loaded))
+
+        # Unknown sids aren't reused
+        c.set_cookie('localhost', self.app.session_cookie_name, 'unknown')
+        resp = c.get('/')
+        self.assertEqual(0, interface.cls.objects(sid='unknown').count())
+        self.assertEqual(2, interface.cls.objects.count())
+
+    def test_binary_payload(self):
+        c = self.app.test_client()
+        c.get('/')
+        collection = self.app.session_interface.cls._get_collection()
+
+        # Sessions stored as documents are still readable
+        self.app.session_interface = MongoEngineSessionInterface(
+            self.db, serializer='pickle', compression='zlib')
+        resp = c.get('/check-session')
+        self.assertEqual('session: hello session', resp.data.decode('utf-8'))
+
+        c.get('/')
+        stored = collection.find_one()
+        self.assertFalse('data' in stored)
+        self.assertEqual('pickle+zlib', stored['encoding'])
+        self.assertEqual(1, stored['version'])
+        resp = c.get('/check-session')
+        self.assertEqual('session: hello session', resp.data.decode('utf-8'))
+
+        # And the other way around
+        self.app.session_interface = MongoEngineSessionInterface(self.db)
+        resp = c.get('/check-session')
+        self.assertEqual('session: hello session', resp.data.decode('utf-8'))
+        c.get('/')
+        stored = collection.find_one()
+        self.assertFalse('payload' in stored)
+        self.assertEqual({'a': 'hello session'}, stored['data'])
+
+    def test_sharding_and_sweeper(self):
+        interface = MongoEngineSessionInterface(self.db, collection='shard',
+                                                shards=4, ttl_index=False)
+        self.app.session_interface = interface
+        c = self.app.test_client()
+        for i in range(8):
+            c.cookie_jar.clear()
+            resp = c.get('/')
+            self.assertEqual('hello session', resp.data.decode('utf-8'))
+        resp = c.get('/check-session')
+        self.assertEqual('session: hello session', resp.data.decode('utf-8'))
+
+        collections = interface._collections()
+        self.assertEqual(['shard_0', 'shard_1', 'shard_2', 'shard_3'],
+                         [collection.name for collection in collections])
+        self.assertEqual(8, sum(col.count_documents({}) for col in collections))
+        for collection in collections:
+            indexes = collection.index_information()
+            self.assertFalse('expireAfterSeconds' in indexes['expiration_1'])
+
+        # Expire half of the sessions
+        past = datetime.datetime.utcnow() - datetime.timedelta(minutes=1)
+        for collection in collections:
+            for doc in list(collection.find())[::2]:
+                collection.update_one({'_id': doc['_id']},
+                                      {'$set': {'expiration': past}})
+        expired = sum(col.count_documents({'expiration': past})
+                      for col in collections)
+
+        self.assertEqual(expired, interface.sweep(batch_size=1))
+        self.assertEqual(8 - expired,
+                         sum(col.count_documents({}) for col in collections))
+        self.assertEqual(0, interface.sweep())
+
+    def test_explicit_indexes(self):
+        if not hasattr(self.app, 'test_cli_runner'):
+            raise SkipTest('The CLI test runner requires Flask >= 1.0')
+
+        interface = MongoEngineSessionInterface(self.db, collection='manual',
+                                                auto_index=False)
+        self.app.session_interface = interface
+        c = self.app.test_client()
+        c.get('/')
+        collection = interface._collection('sid')
+        self.assertFalse('expiration_1' in collection.index_information())
+
+        result = self.app.test_cli_runner().invoke(
+            args=['mongoengine', 'create-session-indexes'])
+        self.assertEqual(0, result.exit_code)
+        self.assertTrue(collection.full_name in result.output)
+        self.assertTrue('expiration_1' in collection.index_information())
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,97 @@
+import flask
+
+from flask_mongoengine import (MongoEngine, MongoEngineSessionInterface,
+                               get_tenant)
+from tests import FlaskMongoEngineTestCase
+
+
+class TenantsTestCase(FlaskMongoEngineTestCase):
+
+    def setUp(self):
+        super(TenantsTestCase, self).setUp()
+        db = MongoEngine()
+
+        class Todo(db.Document):
+            title = db.StringField(max_length=60)
+            meta = {'indexes': ['title']}
+
+        class Tenant(db.Document):
+            name = db.StringField()
+            meta = {'tenant_shared': True}
+
+        db.init_app(self.app)
+        self.Todo = Todo
+        self.Tenant = Tenant
+        self.db = db
+
+        for name in ('tenant_a', 'tenant_b'):
+            with db.tenant(name):
+                Todo.drop_collection()
+        Todo.drop_collection()
+        Tenant.drop_collection()
+
+    def test_tenant_context(self):
+        with self.db.tenant('tenant_a'):
+            self.assertEqual(('default', 'tenant_a'), get_tenant())
+            self.Todo(title='A').save()
+            self.Tenant(name='a').save()
+            self.assertEqual('tenant_a', self.Todo._get_db().name)
+            self.assertEqual(['A'], [t.title for t in self.Todo.objects])
+            self.assertTrue(
+                'title_1' in self.Todo._get_collection().index_information())
+
+            with self.db.tenant('tenant_b'):
+                self.assertEqual(0, self.Todo.objects.count())
+
+        self.assertEqual(None, get_tenant())
+        self.assertEqual(0, self.Todo.objects.count())
+
+        # Shared documents keep using their own database
+        self.assertEqual(['a'], [t.name for t in self.Tenant.objects])
+
+    def test_tenant_resolver(self):
+        @self.db.tenant_resolver
+        def resolve_tenant():
+            return flask.request.headers.get('X-Tenant')
+
+        @self.app.route('/')
+        def index():
+            self.Todo(title='Test').save()
+            return str(self.Todo.objects.count())
+
+        c = self.app.test_client()
+        self.assertEqual(b'1', c.get('/', headers={'X-Tenant': 'tenant_a'}).data)
+        self.assertEqual(b'2', c.get('/', headers={'X-Tenant': 'tenant_a'}).data)
+        self.assertEqual(b'1', c.get('/', headers={'X-Tenant': 'tenant_b'}).data)
+        self.assertEqual(b'1', c.get('/').data)
+        self.assertEqual(None, get_tenant())
+
+    def test_sessions(self):
+        """Make sure sessions stay in their own database under a tenant."""
+        self.app.secret_key = 'secret'
+        self.app.session_interface = MongoEngineSessionInterface(self.db)
+        self.app.session_interface.cls.drop_collection()
+
+        @self.db.tenant_resolver
+        def resolve_tenant():
+            return flask.request.headers.get('X-Tenant')
+
+        @self.app.route('/set')
+        def set_session():
+            flask.session['user'] = 'jane'
+            return 'OK'
+
+        @self.app.route('/get')
+        def get_session():
+            return flask.session.get('user', 'nobody')
+
+        c = self.app.test_client()
+        c.get('/set', headers={'X-Tenant': 'tenant_a'})
+        self.assertEqual(b'jane', c.get('/get').data)
+        self.assertEqual(b'jane', c.get('/get', headers={'X-Tenant': 'tenant_b'}).data)
+
+        # Including for the sweeper, which has no tenant
+        with self.db.tenant('tenant_a'):
+            self.assertEqual(
+                'test_db',
+                self.app.session_interface._collection('sid').database.name)